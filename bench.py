@@ -0,0 +1,328 @@
+"""
+bench
+
+Benchmarks of browsing workloads. Synthetic directory trees (wide,
+deep, many images, many hidden files) are built in a temporary
+directory, and the layers below the gui are timed directly. If Gtk can
+open a display, the gui plug-ins are timed too, for example under Xvfb
+(xvfb-run python3 bench.py) or with GDK_BACKEND=broadway and a running
+broadwayd. Results are printed as JSON so that runs on different
+commits can be compared.
+
+Usage: python3 bench.py [--quick] [--repeat N] [--only TEXT] [--output FILE]
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from os.path import join, dirname, abspath
+
+SOURCE_DIR = dirname(abspath(__file__))
+
+def pngBytes(width, height, seed):
+    """Returns a width x height RGB PNG image with a gradient."""
+    rows = []
+    for y in range(height):
+        row = bytearray([0])
+        for x in range(width):
+            row += bytes(((x + seed) % 256, (y + seed) % 256,
+                          (x * y + seed) % 256))
+        rows.append(bytes(row))
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) +
+            chunk(b"IDAT", zlib.compress(b"".join(rows), 6)) +
+            chunk(b"IEND", b""))
+
+def touch(path, data=b""):
+    """Creates file at path with data."""
+    with open(path, "wb") as f:
+        f.write(data)
+
+def buildTrees(root, scale):
+    """Builds the synthetic trees under root. Returns a dict of
+    workload name: path, plus "root" and "deepest", the last directory
+    of the deep tree."""
+    def count(n):
+        return max(1, int(n * scale))
+    trees = {name: join(root, name)
+             for name in ("wide", "deep", "images", "hidden")}
+    os.mkdir(root)
+    for path in trees.values():
+        os.mkdir(path)
+    trees["root"] = root
+    for i in range(count(20000)):
+        touch(join(trees["wide"], "file{:06d}.txt".format(i)))
+    for i in range(count(1000)):
+        os.mkdir(join(trees["wide"], "dir{:05d}".format(i)))
+    path = trees["deep"]
+    for depth in range(count(100)):
+        for i in range(20):
+            os.mkdir(join(path, "sibling{:02d}".format(i)))
+            touch(join(path, "file{:02d}".format(i)))
+        path = join(path, "level{:03d}".format(depth))
+        os.mkdir(path)
+    trees["deepest"] = path
+    image = pngBytes(512, 384, 0)
+    for i in range(count(300)):
+        touch(join(trees["images"], "image{:04d}.png".format(i)), image)
+    for i in range(count(5000)):
+        touch(join(trees["hidden"], ".hidden{:05d}".format(i)))
+        touch(join(trees["hidden"], "visible{:05d}".format(i)))
+    for i in range(count(500)):
+        os.mkdir(join(trees["hidden"], ".hiddendir{:04d}".format(i)))
+        os.mkdir(join(trees["hidden"], "dir{:04d}".format(i)))
+    # Backdate the directories, dirCache doesn't trust listings of
+    # directories modified in the last seconds.
+    past = time.time() - 60
+    for (path, _, _) in os.walk(root):
+        os.utime(path, (past, past))
+    return trees
+
+def measure(func, repeat, setup=None):
+    """Calls func repeat times, setup being called untimed before each
+    call. Returns timing statistics in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        begin = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - begin) * 1e3)
+    return {"repeat": repeat, "min_ms": min(times),
+            "median_ms": statistics.median(times),
+            "mean_ms": statistics.mean(times), "max_ms": max(times)}
+
+class Bench(object):
+    """Runs the benchmarks and collects their results."""
+
+    def __init__(self, workDir, trees, repeat, only=None):
+        """Creates a Bench working in workDir on trees."""
+        self.workDir = workDir
+        self.trees = trees
+        self.repeat = repeat
+        self.only = only
+        self.results = {}
+
+    def run(self, name, func, setup=None, repeat=None):
+        """Runs benchmark name unless it is filtered out."""
+        if self.only and self.only not in name:
+            return
+        result = measure(func, repeat or self.repeat, setup)
+        self.results[name] = result
+        print("{:<44} {:>10.2f} ms".format(name, result["median_ms"]),
+              file=sys.stderr)
+
+    def skip(self, names, reason):
+        """Records benchmarks that can't run here."""
+        for name in names:
+            if not self.only or self.only in name:
+                self.results[name] = {"skipped": reason}
+                print("{:<44} skipped: {}".format(name, reason),
+                      file=sys.stderr)
+
+    def benchDirCache(self):
+        """Times listing directories with and without a cached
+        listing."""
+        import dirCache
+        caches = []
+        def freshCache():
+            caches.append(dirCache.DirCache(
+                join(self.workDir, "dircache{}.sqlite".format(len(caches)))))
+        for tree in ("wide", "hidden", "images"):
+            path = self.trees[tree]
+            self.run("dirCache.listdir.cold[{}]".format(tree),
+                     lambda: caches[-1].listdir(path), setup=freshCache)
+            self.run("dirCache.listdir.warm[{}]".format(tree),
+                     lambda: caches[-1].listdir(path))
+
+    def benchSignals(self):
+        """Times PluginManager dispatch with synthetic plug-ins."""
+        try:
+            import plugins
+        except ImportError as e:
+            self.skip(["plugins.raiseSignal", "plugins.buildDispatchPlan"],
+                      str(e))
+            return
+        manager = plugins.PluginManager(pluginsList=[], start=False)
+        for i in range(50):
+            plugin = plugins.Plugin(manager)
+            plugin.pname = "bench{}".format(i)
+            plugin.id = i
+            plugin.addResponse("bench", lambda signal, **kwargs: None)
+            if i > 0:
+                plugin.addRespondAfter("bench", "bench{}".format(i - 1))
+            manager.addPlugin(plugin)
+        def raiseMany():
+            for _ in range(1000):
+                manager.raiseSignal("bench", value=1)
+        self.run("plugins.raiseSignal", raiseMany)
+        self.run("plugins.buildDispatchPlan",
+                 lambda: manager.buildDispatchPlan("bench"),
+                 setup=manager.invalidateDispatchPlan)
+
+    def benchThumbnails(self):
+        """Times creating and loading thumbnails of the images."""
+        names = ["thumbnails.createThumbnail.cold[images]",
+                 "thumbnails.createThumbnail.warm[images]",
+                 "thumbnails.createThumbnails.cold[images]"]
+        try:
+            import thumbnails
+        except (ImportError, ValueError) as e:
+            self.skip(names, str(e))
+            return
+        images = sorted(join(self.trees["images"], name)
+                        for name in os.listdir(self.trees["images"]))
+        thumbnailsDir = join(os.path.expanduser("~"), ".cache", "thumbnails")
+        def clear():
+            shutil.rmtree(thumbnailsDir, ignore_errors=True)
+        def createAll():
+            for path in images:
+                thumbnails.createThumbnail(path, 128)
+        self.run(names[0], createAll, setup=clear, repeat=1)
+        self.run(names[1], createAll)
+        self.run(names[2], lambda: thumbnails.createThumbnails(images, 128),
+                 setup=clear, repeat=1)
+
+    def benchGui(self):
+        """Times the dirTree and dirFrame plug-ins on a display."""
+        names = ["dirTree.populate[wide]", "dirTree.populate[hidden]",
+                 "dirTree.onChangeDir[deep]", "dirFrame.onChangeDir[wide]",
+                 "dirFrame.onChangeDir[hidden]",
+                 "dirFrame.getThumbnail[images]"]
+        try:
+            import gi
+            gi.require_version("Gtk", "3.0")
+            from gi.repository import Gtk, Gdk
+        except (ImportError, ValueError) as e:
+            self.skip(names, str(e))
+            return
+        if Gdk.Display.get_default() is None:
+            self.skip(names, "no display")
+            return
+        import settings
+        import plugins
+        settings.SETTINGS_FILE = join(self.workDir, "settings.json")
+        settings.LEGACY_SETTINGS_FILE = join(self.workDir, "settings")
+        with open(settings.SETTINGS_FILE, "w") as f:
+            json.dump({"version": settings.SCHEMA_VERSION,
+                       "settings": {"start-path": self.trees["root"]}}, f)
+        manager = plugins.PluginManager(pluginsList=[
+            "guiManager", "dirTree", "dirFrame", "settings",
+            "dirWatcher signals=watch-dir,unwatch-dir"])
+        tree = manager.pluginNames["dirTree"]
+        frame = [p for p in manager.plugins
+                 if type(p).__name__ == "DirFrame"][0]
+        def drain(until=None, timeout=60):
+            """Runs the main loop until it is idle and until() is
+            true."""
+            end = time.time() + timeout
+            while ((Gtk.events_pending() or
+                    (until is not None and not until()))
+                   and time.time() < end):
+                Gtk.main_iteration_do(False)
+        drain()
+        import dirTree
+        # Nodes register in the path index of their DirTree, a separate
+        # one keeps the index of the tree shown intact
+        scratch = dirTree.DirTree(manager)
+        scratch.showHidden = tree.showHidden
+        for workload in ("wide", "hidden"):
+            path = self.trees[workload]
+            nodes = []
+            def newNode():
+                if nodes:
+                    scratch.forgetNode(nodes.pop())
+                nodes.append(dirTree.DirNode(path, scratch, 1))
+            self.run("dirTree.populate[{}]".format(workload),
+                     lambda: nodes[-1].populate(), setup=newNode)
+            if nodes:
+                scratch.forgetNode(nodes.pop())
+        def collapseDeep():
+            manager.raiseSignal("change-dir", newPath=self.trees["root"])
+            node = tree.nodes.get(self.trees["deep"])
+            if node is not None and node.isToggledOn:
+                node.toggle()
+            drain()
+        self.run("dirTree.onChangeDir[deep]",
+                 lambda: (tree.onChangeDir("change-dir",
+                                           newPath=self.trees["deepest"]),
+                          drain()),
+                 setup=collapseDeep)
+        def leave():
+            manager.raiseSignal("change-dir", newPath=self.trees["root"])
+            drain(lambda: frame.scanner is None)
+        for workload in ("wide", "hidden"):
+            path = self.trees[workload]
+            self.run("dirFrame.onChangeDir[{}]".format(workload),
+                     lambda: (manager.raiseSignal("change-dir", newPath=path),
+                              drain(lambda: frame.scanner is None)),
+                     setup=leave)
+        import dirFrame
+        images = sorted(join(self.trees["images"], name)
+                        for name in os.listdir(self.trees["images"]))
+        self.run("dirFrame.getThumbnail[images]",
+                 lambda: [dirFrame.getThumbnail(path, 128)
+                          for path in images])
+
+def gitCommit():
+    """Returns the commit of the source tree or None."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=SOURCE_DIR,
+                                       stderr=subprocess.DEVNULL
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    """Builds the trees, runs the benchmarks and prints the results."""
+    parser = argparse.ArgumentParser(description="filebrowser benchmarks")
+    parser.add_argument("--quick", action="store_true",
+                        help="use trees a tenth of the normal size")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", help="run benchmarks containing TEXT")
+    parser.add_argument("--output", help="write JSON to FILE")
+    args = parser.parse_args()
+    scale = 0.1 if args.quick else 1.0
+    workDir = tempfile.mkdtemp(prefix="filebrowser-bench-")
+    # Keep thumbnails and caches out of the user's home directory
+    os.environ["HOME"] = join(workDir, "home")
+    os.environ["XDG_CACHE_HOME"] = join(workDir, "home", ".cache")
+    os.makedirs(os.environ["XDG_CACHE_HOME"])
+    sys.path.insert(0, SOURCE_DIR)
+    try:
+        begin = time.perf_counter()
+        trees = buildTrees(join(workDir, "trees"), scale)
+        print("trees built in {:.1f} s".format(time.perf_counter() - begin),
+              file=sys.stderr)
+        bench = Bench(workDir, trees, args.repeat, args.only)
+        bench.benchDirCache()
+        bench.benchSignals()
+        bench.benchThumbnails()
+        bench.benchGui()
+        report = {"commit": gitCommit(), "python": platform.python_version(),
+                  "platform": platform.platform(), "scale": scale,
+                  "results": bench.results}
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    output = json.dumps(report, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
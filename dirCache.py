@@ -0,0 +1,248 @@
+"""
+dirCache
+
+Persistent cache of directory listings. The entries of each directory
+are kept with their type, size and modification time in a SQLite
+database under the user's cache directory. A listing is trusted as
+long as the directory's own mtime hasn't changed, so revisiting a
+directory costs a single stat.
+"""
+
+import os
+from os.path import join, expanduser, split
+import stat
+import sqlite3
+import time
+from collections import namedtuple
+from threading import Lock
+
+FILE = "f"
+DIR = "d"
+OTHER = "o"
+
+# Listings of directories modified less than this many nanoseconds
+# before the scan are not trusted, as a change in the same mtime tick
+# would go unnoticed.
+RACY_NS = 2 * 10**9
+
+def defaultCachePath():
+    """Returns the path of the cache database."""
+    cacheHome = os.environ.get("XDG_CACHE_HOME") or expanduser("~/.cache")
+    return join(cacheHome, "filebrowser", "dircache.sqlite")
+
+class DirEntry(namedtuple("DirEntry", "path name type size mtime")):
+    """An entry of a directory listing. type is FILE, DIR or OTHER,
+    mtime is in nanoseconds."""
+    __slots__ = ()
+
+    def isDir(self):
+        """Returns whether the entry is a directory."""
+        return self.type == DIR
+
+    def isFile(self):
+        """Returns whether the entry is a regular file."""
+        return self.type == FILE
+
+def statEntry(path):
+    """Returns a DirEntry for path, None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        # broken symbolic link
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+    if stat.S_ISDIR(st.st_mode):
+        kind = DIR
+    elif stat.S_ISREG(st.st_mode):
+        kind = FILE
+    else:
+        kind = OTHER
+    return DirEntry(path, split(path)[1], kind, st.st_size, st.st_mtime_ns)
+
+def scanTypes(path, cancelled=None):
+    """Lists directory at path with the types of the entries taken from
+    d_type, so they are not stat'ed on most file systems. The size and
+    mtime of the DirEntries are None. Raises OSError if path can't be
+    listed, returns None if cancelled is set before the listing is
+    over."""
+    entries = []
+    with os.scandir(path) as dirEntries:
+        for entry in dirEntries:
+            if cancelled is not None and cancelled.is_set():
+                return None
+            try:
+                if entry.is_dir():
+                    kind = DIR
+                elif entry.is_file():
+                    kind = FILE
+                else:
+                    kind = OTHER
+            except OSError:
+                kind = OTHER
+            entries.append(DirEntry(entry.path, entry.name, kind, None, None))
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+class DirCache(object):
+    """Directory listings cached in a SQLite database. Safe to use from
+    several threads."""
+
+    def __init__(self, dbPath=None):
+        """Opens the cache at dbPath, an in-memory cache is used if the
+        database can't be opened."""
+        if dbPath is None:
+            dbPath = defaultCachePath()
+        self.lock = Lock()
+        try:
+            os.makedirs(os.path.dirname(dbPath), exist_ok=True)
+            self.db = self.connect(dbPath)
+        except (OSError, sqlite3.Error):
+            self.db = self.connect(":memory:")
+
+    def connect(self, dbPath):
+        """Opens the database and creates the tables if needed."""
+        db = sqlite3.connect(dbPath, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS dirs "
+                   "(path TEXT PRIMARY KEY, mtime INTEGER)")
+        db.execute("CREATE TABLE IF NOT EXISTS entries "
+                   "(dir TEXT, name TEXT, type TEXT, size INTEGER, "
+                   "mtime INTEGER, PRIMARY KEY (dir, name)) WITHOUT ROWID")
+        db.commit()
+        return db
+
+    def cachedListdir(self, path):
+        """Returns the cached DirEntries of path if they are up to date,
+        None otherwise. Never scans the directory."""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        return self.lookup(path, mtime)
+
+    def lookup(self, path, mtime):
+        """Returns the cached DirEntries of path if they were stored for
+        mtime, None otherwise. A database error is treated as a miss."""
+        with self.lock:
+            try:
+                row = self.db.execute("SELECT mtime FROM dirs WHERE path=?",
+                                      (path,)).fetchone()
+                if row is None or row[0] != mtime:
+                    return None
+                rows = self.db.execute("SELECT name, type, size, mtime "
+                                       "FROM entries WHERE dir=? "
+                                       "ORDER BY name", (path,))
+                return [DirEntry(join(path, name), name, kind, size, m)
+                        for (name, kind, size, m) in rows]
+            except (sqlite3.Error, UnicodeEncodeError):
+                return None
+
+    def listdir(self, path, cancelled=None):
+        """Returns the DirEntries of directory at path sorted by name,
+        rescanning it only if it changed. Raises OSError if path can't
+        be listed. A rescan stops and None is returned once cancelled,
+        a threading.Event, is set."""
+        mtime = os.stat(path).st_mtime_ns
+        entries = self.lookup(path, mtime)
+        if entries is not None:
+            return entries
+        entries = self.scan(path, cancelled)
+        if entries is None:
+            return None
+        self.storeScanned(path, mtime, entries)
+        return entries
+
+    def statListing(self, path, mtime, entries, cancelled=None):
+        """Stats entries, the listing of directory at path returned by
+        scanTypes, and stores them, so the directory isn't listed a
+        second time. mtime is the directory's mtime taken before it was
+        listed. Entries removed meanwhile are dropped. Returns the
+        stat'ed DirEntries, None if cancelled is set before they all
+        are."""
+        statted = []
+        for entry in entries:
+            if cancelled is not None and cancelled.is_set():
+                return None
+            entry = statEntry(entry.path)
+            if entry is not None:
+                statted.append(entry)
+        self.storeScanned(path, mtime, statted)
+        return statted
+
+    def scan(self, path, cancelled=None):
+        """Lists directory at path and stats its entries. Returns None
+        if cancelled is set before the scan is over."""
+        entries = []
+        with os.scandir(path) as dirEntries:
+            for entry in dirEntries:
+                if cancelled is not None and cancelled.is_set():
+                    return None
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # broken symbolic link
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                if entry.is_dir():
+                    kind = DIR
+                elif entry.is_file():
+                    kind = FILE
+                else:
+                    kind = OTHER
+                entries.append(DirEntry(entry.path, entry.name, kind,
+                                        st.st_size, st.st_mtime_ns))
+        entries.sort(key=lambda e: e.name)
+        return entries
+
+    def storeScanned(self, path, mtime, entries):
+        """Stores entries scanned from path, mtime being the directory's
+        mtime before the scan. Listings of directories modified just
+        before the scan are stored to be rescanned."""
+        if time.time_ns() - mtime < RACY_NS:
+            mtime = None
+        self.store(path, mtime, entries)
+
+    def store(self, path, mtime, entries):
+        """Replaces the cached listing of path. A listing stored with
+        mtime None is rescanned on the next listdir."""
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.execute("DELETE FROM entries WHERE dir=?",
+                                    (path,))
+                    self.db.executemany(
+                        "INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+                        [(path, e.name, e.type, e.size, e.mtime)
+                         for e in entries])
+                    self.db.execute("INSERT OR REPLACE INTO dirs "
+                                    "VALUES (?, ?)", (path, mtime))
+            except (sqlite3.Error, UnicodeEncodeError):
+                # names that are not valid UTF-8 can't be stored
+                pass
+
+    def invalidate(self, path):
+        """Makes the next listdir of path rescan it."""
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.execute("UPDATE dirs SET mtime=NULL "
+                                    "WHERE path=?", (path,))
+            except sqlite3.Error:
+                pass
+
+cache = None
+cacheLock = Lock()
+
+def getCache():
+    """Returns the DirCache shared by the process, opening it on first
+    use."""
+    global cache
+    with cacheLock:
+        if cache is None:
+            cache = DirCache()
+    return cache
@@ -1,104 +1,32 @@
 import platform
 import os
-from os.path import join, isdir
-import hashlib
-import urllib
-import re
-from mimetypes import guess_type
+from functools import partial
 
-from gi.repository import Gtk, Gdk, GObject, Pango, GdkPixbuf
-from gi.repository.GdkPixbuf import Pixbuf
+from gi.repository import Gtk, Gdk, GObject, GLib, Pango
 
 import settings
 import plugins
-
-def chunks(l, n):
-    """ Yield successive n-sized chunks from l."""
-    for i in range(0, len(l), n):
-        yield l[i:i+n]
+from dirScanner import DirScanner
+import dirCache
+import thumbnailers
+from thumbnails import createThumbnail, ThumbnailService, pixbufCache
 
 def isHidden(path):
     """Returns whether file at the given path is hidden."""
     (_, fname) = os.path.split(path)
     return (fname[0]=="." or fname[-1]=="~")
 
-def pathToThumbnailPath(path, size):
-    """Returns path to thumbnail of file at path (uses Gnome thumbnails)"""
-    #PORT other platforms than gnome
-    encodedUrl = ('file://' + path).encode()
-    hashedUrl = hashlib.md5(encodedUrl).hexdigest()
-    homeDir = (os.path.expanduser("~"))
-    if size <= 128: sizeDir = "normal"
-    else: sizeDir = "large"
-    thumbnailsDir = "{home}/.cache/thumbnails/{size}/".format(home = homeDir,
-                                                              size = sizeDir)
-    return (thumbnailsDir + hashedUrl + ".png")
-
-def loadThumbnailers():
-    """Load thumbnailers
-    thumbnailer files should be saved in thumbnailersDir and must be written
-    in Gnome's thumbnailer entry format"""
-    thumbnailers = {}
-    #PORT make setting
-    thumbnailersDir = "/usr/share/thumbnailers/"
-    if isdir(thumbnailersDir):
-        for filename in os.listdir(thumbnailersDir):
-            command = ""
-            tFile = open(join(thumbnailersDir, filename), "r").readlines()
-            for line in tFile:
-                if line[:5] == "Exec=":
-                    command = line[5:]
-                if line[:9] == "MimeType=":
-                    for mime in line[9:].split(";"):
-                        thumbnailers[mime] = command
-    return thumbnailers
+def loadDefaultIcon(size):
+    """Returns the icon shown for files without a thumbnail."""
+    return Gtk.IconTheme.get_default().load_icon("gtk-file", size, 0)
 
 def getThumbnail(path, size):
     """Gets thumbnail for file at path. The function will try to create
-    one if it is not found. Returns None if this fails."""
-    defaultIcon = Gtk.IconTheme.get_default().load_icon("gtk-file", size, 0)
-    thumbnailPath = pathToThumbnailPath(path, size)
-    thumbnailers = loadThumbnailers()
-    pixbuf = None
-    try: 
-        return Pixbuf.new_from_file_at_size(thumbnailPath, size, size)
-    except: 
-        pass
-    if size>128:
-        tsize = 256
-    else:
-        tsize = 128
-    try:    
-        pixbuf = Pixbuf.new_from_file_at_size(path, tsize, tsize)
-    except:
-        pass
-    if pixbuf is None and guess_type(path)[0] in thumbnailers.keys():
-        o = '"{}"'.format(thumbnailPath)
-        u = '"file://{}"'.format(path)
-        i = '"{}"'.format(path)
-        s = str(tsize)
-        command = thumbnailers[guess_type(path)[0]]
-        for (pat, sub) in [("%o", o), ("%i", i), ("%u", u), ("%s", s)]:
-            command = re.sub(pat, sub, command)       
-        os.system(command)
-        try:
-            pixbuf = Pixbuf.new_from_file_at_size(thumbnailPath, tsize, tsize)
-        except:
-            return defaultIcon
-    if pixbuf is None:
-        return defaultIcon
-    pixbuf.savev(thumbnailPath, "png", [], [])
-    width = pixbuf.get_width()
-    height = pixbuf.get_height()
-    if height > width:
-        width = size * width / height
-        height = size
-    else:
-        height = size * height / width
-        width = size
-    pixbuf = pixbuf.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR)
-    return pixbuf
-    
+    one if it is not found. Returns the default icon if this fails."""
+    thumbnail = createThumbnail(path, size)
+    if thumbnail is None:
+        return loadDefaultIcon(size)
+    return thumbnail
 
 def openFile(path):
     """Opens file at given path."""
@@ -130,12 +58,51 @@ class ThumbnailSizeSetting(settings.Setting):
         """Sets thumbnail size to the default value."""
         self.set(128)
 
+class ThumbnailWorkersSetting(settings.Setting):
+    """Setting for the number of threads creating thumbnails."""
+
+    def __init__(self):
+        """Creates ThumbnailWorkersSetting object."""
+        settings.Setting.__init__(self)
+        self.setToDefault()
+
+    def isValidValue(self, value):
+        """Returns whether value is a valid number of threads."""
+        return (type(value) is int) and (0 < value <= 64)
+
+    def setToDefault(self):
+        """Sets the number of threads to the number of processors."""
+        self.set(min(os.cpu_count() or 4, 64))
+
+class ThumbnailCacheSizeSetting(settings.Setting):
+    """Setting for the memory, in MB, used to keep thumbnails of
+    visited directories."""
+
+    def __init__(self):
+        """Creates ThumbnailCacheSizeSetting object."""
+        settings.Setting.__init__(self)
+        self.setToDefault()
+
+    def isValidValue(self, value):
+        """Returns whether value is a valid size in MB."""
+        return (type(value) is int) and (0 <= value < 60000)
+
+    def setToDefault(self):
+        """Sets the cache size to the default value."""
+        self.set(64)
+
+settings.registerSetting("thumbnail-size", ThumbnailSizeSetting)
+settings.registerSetting("thumbnail-workers", ThumbnailWorkersSetting)
+settings.registerSetting("thumbnail-cache-size", ThumbnailCacheSizeSetting)
+
 class FileWidget(Gtk.Box):
     """Widget for showing files. Shows a thumbnail and file name.
     This also raises file-select and file-activate signals."""
     
-    def __init__(self, path, size, margin):
-        """Creates a FileWidget by loading/creating the thumbnail"""
+    def __init__(self, path, size, margin, thumbnail=None):
+        """Creates a FileWidget showing thumbnail. The thumbnail is
+        loaded/created if it is None, use a placeholder pixbuf and
+        setThumbnail to load it later."""
         Gtk.Box.__init__(self, orientation = Gtk.Orientation.VERTICAL)
         self.pluginManager = None
         self.path = path
@@ -147,7 +114,8 @@ class FileWidget(Gtk.Box):
         #This somehow makes ellipsize work
         self.label.set_max_width_chars(1)      
         
-        thumbnail = getThumbnail(self.path, size)
+        if thumbnail is None:
+            thumbnail = getThumbnail(self.path, size)
         self.image = Gtk.Image()
         self.label.set_margin_left(margin)
         self.label.set_margin_right(margin) 
@@ -155,181 +123,409 @@ class FileWidget(Gtk.Box):
             self.image.set_from_pixbuf(thumbnail)
         self.pack_start(self.image, True, True, 5)
         self.pack_start(self.label, False, False, 5)
+
+    def setPath(self, path):
+        """Makes the widget show file at path."""
+        self.path = path
+        (_, self.fname) = os.path.split(path)
+        self.label.set_text(self.fname)
+
+    def setThumbnail(self, thumbnail):
+        """Shows thumbnail, a Pixbuf."""
+        self.image.set_from_pixbuf(thumbnail)
     
-class FlexibleGrid(Gtk.Grid, Gtk.EventBox):
-    """A subclass of Gtk.Grid that orders its children in a grid
-    with a given column width. The number of columns is adjusted
-    automatically."""
+class FlexibleGrid(Gtk.Fixed):
+    """A container that shows a list of items in a grid with a given
+    column width. The number of columns is adjusted automatically.
+    Only items in the rows visible in the scrolled window, plus a few
+    rows of overscan, have widgets. These are recycled while
+    scrolling. Subclasses create the widgets in create_child and show
+    an item on a widget in bind_child."""
     
-    def __init__(self, column_width = 100):
-        """ Creates a FlexibleGrid with given column_with."""
-        Gtk.EventBox.__init__(self)        
-        Gtk.Grid.__init__(self)
-        self.connect("draw", self.draw)
+    def __init__(self, column_width = 100, row_height = 100, overscan = 2):
+        """ Creates a FlexibleGrid with given column_width and
+        row_height."""
+        Gtk.Fixed.__init__(self)
+        self.connect("size-allocate", self.on_size_allocate)
         self.connect("key-press-event", self.on_key_press_event)
         self.column_width = column_width
+        self.row_height = row_height
+        #Number of rows realized above and below the visible ones
+        self.overscan = overscan
         #Number of columns to show
         self.columns = 1
-        self.set_column_homogeneous(True)
-        #Used to reorder children in the right order
-        self.ordered_children = []
-        self.selected = []
+        self.items = []
+        #index: EventBox for items having a widget
+        self.realized = {}
+        #EventBoxes not in use, ready to be recycled
+        self.spare = []
+        self.adjustment = None
+        self.refresh_source = None
+        self.reflow_source = None
+        #Milliseconds to wait for the width to settle before reflowing
+        self.reflow_delay = 150
+        #Indexes of the selected items
+        self.selected = set()
+        #Incremented whenever the selection changes
+        self.selection_version = 0
         self.cursor_at = None
         self.secondary_cursor_at = None
- 
-    def add(self, child):
-        """Add child wrapped in an EventBox."""
-        items = len(self.ordered_children)
-        column = items % self.columns
-        row = items // self.columns
-        ebox = Gtk.EventBox()
-        ebox.add(child)
-        ebox.connect("button-press-event", self.on_button_press_event)
-        self.ordered_children.append(child)  
-        Gtk.Grid.attach(self, ebox, column, row, 1, 1)
-
-    def remove(self, child):
-        """Removes child."""
-        self.ordered_children.remove(child)
-        eventBox = child.get_parent()
-        Gtk.Grid.remove(self, eventBox)
-        
-    def draw(self, event, cr):
-        """Orders children in rows and columns and calls
-        Gtk.Grid.draw. This doesn't work right if there is a children
-        with a width greater than self.column_width."""
-        width = self.get_allocated_width()
-        columns = int(width / self.column_width)
+
+    def do_get_preferred_width(self):
+        """Requests a single column, so that the grid can shrink."""
+        return (self.column_width, self.column_width)
+
+    def do_get_preferred_height(self):
+        """Requests the height of all rows."""
+        rows = -(-len(self.items) // self.columns)
+        return (rows * self.row_height, rows * self.row_height)
+
+    def set_vadjustment(self, adjustment):
+        """Sets the vertical adjustment of the scrolled window the grid
+        is shown in. Rows are realized as it scrolls."""
+        self.adjustment = adjustment
+        adjustment.connect("value-changed", self.on_scroll)
+        adjustment.connect("changed", self.on_scroll)
+
+    def set_items(self, items):
+        """Replaces the items shown and clears the selection."""
+        for index in list(self.realized):
+            self.release(index)
+        self.items = list(items)
+        self.set_selection(set())
+        self.cursor_at = None
+        self.secondary_cursor_at = None
+        self.queue_resize()
+        self.queue_refresh()
+
+    def update_items(self, items, key):
+        """Replaces the items shown, keeping selection and cursor on the
+        items still present. key(item) identifies an item. Widgets
+        whose index still holds an equal item are kept as they are,
+        only the indexes that changed are bound again."""
+        selectedKeys = [key(self.items[i]) for i in self.selected]
+        cursorKeys = [None if i is None else key(self.items[i])
+                      for i in (self.cursor_at, self.secondary_cursor_at)]
+        items = list(items)
+        for index in list(self.realized):
+            if index >= len(items) or items[index] != self.items[index]:
+                self.release(index)
+        self.items = items
+        positions = {key(item): i for (i, item) in enumerate(self.items)}
+        (self.cursor_at, self.secondary_cursor_at) = \
+            [positions.get(k) for k in cursorKeys]
+        self.set_selection({positions[k] for k in selectedKeys
+                            if k in positions})
+        self.queue_resize()
+        self.queue_refresh()
+
+    def replace_items(self, items):
+        """Replaces the items by equal ones in the same order, like the
+        same files with more details. The widgets are not bound
+        again."""
+        self.items = list(items)
+
+    def append_items(self, items):
+        """Adds items to the end of the grid."""
+        self.items.extend(items)
+        self.queue_resize()
+        self.queue_refresh()
+
+    def create_child(self, index):
+        """Returns a new widget for showing items. Override this."""
+        return Gtk.Label()
+
+    def bind_child(self, child, index):
+        """Shows self.items[index] on child. Override this."""
+        child.set_text(str(self.items[index]))
+
+    def unbind_child(self, child, index):
+        """Called before child stops showing self.items[index]."""
+        pass
+
+    def position(self, index):
+        """Returns (x, y) of the cell showing item at index."""
+        return ((index % self.columns) * self.column_width,
+                (index // self.columns) * self.row_height)
+
+    def visible_range(self):
+        """Returns (first, last) indexes of the items to realize, last
+        excluded."""
+        if self.adjustment is None:
+            top = 0
+            bottom = self.get_allocated_height()
+        else:
+            # The grid is not necessarily at the top of the scrolled area
+            top = self.adjustment.get_value() - self.get_allocation().y
+            bottom = top + self.adjustment.get_page_size()
+        first_row = max(0, int(top // self.row_height) - self.overscan)
+        last_row = int(bottom // self.row_height) + 1 + self.overscan
+        return (min(len(self.items), first_row * self.columns),
+                min(len(self.items), last_row * self.columns))
+
+    def queue_refresh(self):
+        """Refreshes realized rows before the next frame is drawn."""
+        if self.refresh_source is None:
+            self.refresh_source = GLib.idle_add(
+                self.refresh, priority=GLib.PRIORITY_HIGH_IDLE)
+
+    def refresh(self):
+        """Realizes the visible rows and recycles the others."""
+        self.refresh_source = None
+        (first, last) = self.visible_range()
+        for index in [i for i in self.realized if not first <= i < last]:
+            self.release(index)
+        for index in range(first, last):
+            if index not in self.realized:
+                self.realize(index)
+        return False
+
+    def realize(self, index):
+        """Gives item at index a widget, recycling a spare one if
+        possible."""
+        if self.spare:
+            ebox = self.spare.pop()
+        else:
+            ebox = Gtk.EventBox()
+            ebox.set_size_request(self.column_width, self.row_height)
+            ebox.add(self.create_child(index))
+            ebox.connect("button-press-event", self.on_button_press_event)
+            #Only the grid decides which EventBoxes are visible
+            ebox.set_no_show_all(True)
+            self.put(ebox, 0, 0)
+        ebox.index = index
+        child = ebox.get_child()
+        self.bind_child(child, index)
+        if index in self.selected:
+            child.set_state(Gtk.StateType.SELECTED)
+        else:
+            child.set_state(Gtk.StateType.NORMAL)
+        (x, y) = self.position(index)
+        self.move(ebox, x, y)
+        child.show_all()
+        ebox.show()
+        self.realized[index] = ebox
+
+    def release(self, index):
+        """Takes the widget of item at index back to the spare ones."""
+        ebox = self.realized.pop(index)
+        self.unbind_child(ebox.get_child(), index)
+        ebox.hide()
+        self.spare.append(ebox)
+
+    def on_scroll(self, adjustment):
+        """Realizes rows scrolled into view."""
+        self.queue_refresh()
+
+    def on_size_allocate(self, widget, allocation):
+        """Orders items in columns fitting the new width. While the
+        width keeps changing, as in an interactive resize, the reflow
+        is postponed until it settles."""
+        columns = max(1, allocation.width // self.column_width)
+        if self.reflow_source is not None:
+            GLib.source_remove(self.reflow_source)
+            self.reflow_source = None
         if columns != self.columns:
-        #Reorder if number of columns has changed.
-            self.columns = columns
-            for ebox in self.get_children():
-                ebox.remove(ebox.get_child())
-                Gtk.Grid.remove(self, ebox)
-            row = 0
-            column = 0
-            for child in self.ordered_children:
-                ebox = Gtk.EventBox()
-                ebox.add(child)
-                ebox.connect("button-press-event", self.on_button_press_event)
-                self.attach(ebox, column, row, 1, 1)
-                column += 1
-                if column == columns:
-                    column = 0
-                    row += 1
-            Gtk.Grid.draw(self, cr)
-            self.show_all()
-        self.show_all() #This is needed because the children are
-                        #just added.
+            if self.realized:
+                self.reflow_source = GLib.timeout_add(self.reflow_delay,
+                                                      self.reflow, columns)
+            else:
+                # Nothing to move, the first refresh already uses the
+                # new columns; the resize can't be queued while
+                # allocating
+                self.columns = columns
+                self.reflow_source = GLib.idle_add(self.reflow, columns)
+        self.queue_refresh()
+
+    def reflow(self, columns):
+        """Moves the realized widgets to their cells for the given
+        number of columns. The widgets keep their items."""
+        self.reflow_source = None
+        self.columns = columns
+        for (index, ebox) in self.realized.items():
+            (x, y) = self.position(index)
+            self.move(ebox, x, y)
+        self.queue_resize()
+        self.refresh()
+        return False
+
+    def scroll_to(self, index):
+        """Scrolls so that the item at index is visible."""
+        if self.adjustment is None:
+            return
+        (_, y) = self.position(index)
+        y += self.get_allocation().y
+        top = self.adjustment.get_value()
+        page = self.adjustment.get_page_size()
+        if y < top:
+            self.adjustment.set_value(y)
+        elif y + self.row_height > top + page:
+            self.adjustment.set_value(y + self.row_height - page)
                         
     def on_button_press_event(self, eventbox, event):
         self.grab_focus()
-        widget = eventbox.get_child()
+        index = eventbox.index
         modifiers = Gtk.accelerator_get_default_mod_mask()
         ctrl = event.state & modifiers == Gdk.ModifierType.CONTROL_MASK
         shift = event.state & modifiers == Gdk.ModifierType.SHIFT_MASK
-        selected_old = self.selected[:]
         self.secondary_cursor_at = self.cursor_at
-        self.cursor_at = self.ordered_children.index(widget)
-        if not ctrl:
-            self.selected = []
+        self.cursor_at = index
+        if ctrl:
+            selected = set(self.selected)
+        else:
+            selected = set()
         if shift:
             if self.secondary_cursor_at is not None:
                 cursors = [self.secondary_cursor_at, self.cursor_at]
                 cursors.sort()
                 smaller = cursors[0]
                 greater = cursors[1]
-                self.selected = self.ordered_children[smaller:greater+1]
+                selected = set(range(smaller, greater+1))
                 # When using shift, cursor should remain the same
                 self.cursor_at, self.secondary_cursor_at = \
                     self.secondary_cursor_at, self.cursor_at
         else:
             self.secondary_cursor_at = self.cursor_at
         if ctrl:
-            if widget in self.selected:
-                self.selected.remove(widget)
-            else:
-                self.selected.append(widget)
-        elif widget not in self.selected:
-            self.selected.append(widget)
-        self.update_selection(selected_old)
+            selected.symmetric_difference_update((index,))
+        else:
+            selected.add(index)
+        self.set_selection(selected)
  
     def on_key_press_event(self, widget, event):
         keyname = Gdk.keyval_name(event.keyval)
+        modifiers = Gtk.accelerator_get_default_mod_mask()
+        ctrl = event.state & modifiers == Gdk.ModifierType.CONTROL_MASK
         if keyname in ["Left", "Right", "Up", "Down"]:
             return self.move_selection_by_key(event)
+        if ctrl and keyname in ["a", "A"]:
+            self.set_selection(set(range(len(self.items))))
+            return True
             
     def move_selection_by_key(self, event):
+        if not self.items:
+            return True
         keyname = Gdk.keyval_name(event.keyval)
         modifiers = Gtk.accelerator_get_default_mod_mask()
         ctrl = event.state & modifiers == Gdk.ModifierType.CONTROL_MASK
         shift = event.state & modifiers == Gdk.ModifierType.SHIFT_MASK
         dif = {"Up": -self.columns, "Down": self.columns,
               "Left": -1, "Right":1}
-        selected_old = self.selected[:]
         if ctrl:
             pass #TODO implement
         elif shift and self.cursor_at is not None:
             if (0 <= self.secondary_cursor_at + dif[keyname] 
-                    < len(self.ordered_children)):
+                    < len(self.items)):
                 self.secondary_cursor_at += dif[keyname]
                 cursors = [self.secondary_cursor_at, self.cursor_at]
                 cursors.sort()
                 smaller = cursors[0]
                 greater = cursors[1]
-                self.selected = self.ordered_children[smaller:greater+1]
-                self.update_selection(selected_old)
+                self.set_selection(set(range(smaller, greater+1)))
+                self.scroll_to(self.secondary_cursor_at)
         elif self.cursor_at is not None:
             if self.secondary_cursor_at is not None:
                 self.cursor_at = self.secondary_cursor_at
-            if 0 <= self.cursor_at + dif[keyname] < len(self.ordered_children):    
+            if 0 <= self.cursor_at + dif[keyname] < len(self.items):
                 self.cursor_at += dif[keyname]
                 self.secondary_cursor_at = self.cursor_at
-                self.selected = [self.ordered_children[self.cursor_at]]
-                self.update_selection(selected_old)
+                self.set_selection({self.cursor_at})
+                self.scroll_to(self.cursor_at)
         if self.cursor_at is None:
             self.cursor_at = 0
-            self.selected = [self.ordered_children[self.cursor_at]]
-            self.update_selection([])
+            self.set_selection({self.cursor_at})
+            self.scroll_to(self.cursor_at)
         return True    
 
-    def update_selection(self, selected_old):
-        to_select = [i for i in self.selected if i not in selected_old]
-        to_deselect = [i for i in selected_old if i not in self.selected]
-        for item in to_select:
-            item.set_state(Gtk.StateType.SELECTED)
-        for item in to_deselect:
-            item.set_state(Gtk.StateType.NORMAL) 
+    def set_selection(self, selected):
+        """Replaces the selection with selected, a set of indexes. Only
+        the realized widgets have to be updated, the others get their
+        state when they are bound."""
+        if selected == self.selected:
+            return
+        self.selected = selected
+        self.selection_version += 1
+        for (index, ebox) in self.realized.items():
+            if index in selected:
+                ebox.get_child().set_state(Gtk.StateType.SELECTED)
+            else:
+                ebox.get_child().set_state(Gtk.StateType.NORMAL)
 
 class MainDirGrid(FlexibleGrid):
+    """FlexibleGrid showing the files of a directory, given as
+    dirCache.DirEntries, as FileWidgets. Thumbnails are requested from
+    thumbnailService for the files having a widget only."""
 
-    def __init__(self, settings, manager, columnWidth=100):
-        FlexibleGrid.__init__(self, columnWidth)
+    def __init__(self, settings, manager, thumbnailService, thumbnailSize,
+                 placeholder, columnWidth=100, rowHeight=100):
+        FlexibleGrid.__init__(self, columnWidth, rowHeight)
         self.settings = settings
         self.manager = manager
+        self.thumbnailService = thumbnailService
+        self.thumbnailSize = thumbnailSize
+        self.placeholder = placeholder
+        # FileWidget: (ThumbnailJob, callback) of thumbnails not loaded yet
+        self.jobs = {}
+
+    def create_child(self, index):
+        """Creates a FileWidget showing a placeholder."""
+        return FileWidget(self.items[index].path, self.thumbnailSize, 10,
+                          self.placeholder)
+
+    def bind_child(self, child, index):
+        """Shows file at index on child and requests its thumbnail."""
+        entry = self.items[index]
+        child.setPath(entry.path)
+        child.setThumbnail(self.placeholder)
+        callback = partial(self.onThumbnail, child)
+        # The worker stats the file for the pixbufCache key, the mtime
+        # of a cached listing misses files modified in place
+        job = self.thumbnailService.request(entry.path, self.thumbnailSize,
+                                            callback, index)
+        if job is not None:
+            self.jobs[child] = (job, callback)
+
+    def unbind_child(self, child, index):
+        """Drops the thumbnail request of child."""
+        (job, callback) = self.jobs.pop(child, (None, None))
+        if job is not None:
+            self.thumbnailService.cancel(job, callback)
+
+    def onThumbnail(self, child, path, pixbuf):
+        """Shows the thumbnail created for path on child, keeps the
+        placeholder if no thumbnail could be created."""
+        if child.path != path:
+            return
+        self.jobs.pop(child, None)
+        if pixbuf is not None:
+            child.setThumbnail(pixbuf)
         
     def on_button_press_event(self, widget, event):
-        oldSelection = self.selected[:]
+        oldSelection = self.selection_version
         if event.type == Gdk.EventType.BUTTON_PRESS:
             FlexibleGrid.on_button_press_event(self, widget, event)
-            if self.selected[:] != oldSelection:
+            if self.selection_version != oldSelection:
                 self.manager.raiseSignal("file-selected",
-                                         files=[f.path for f in self.selected])
+                                         files=self.selectedItems())
         elif event.type == Gdk.EventType.DOUBLE_BUTTON_PRESS:
             self.manager.raiseSignal("file-activated",
-                                     files=[f.path for f in self.selected])
+                                     files=self.selectedItems())
         return True
         
     def on_key_press_event(self, widget, event):
-        oldSelection = self.selected[:]
+        oldSelection = self.selection_version
         FlexibleGrid.on_key_press_event(self, widget, event)
-        if self.selected[:] != oldSelection:
+        if self.selection_version != oldSelection:
             self.manager.raiseSignal("file-selected", 
-                                     files=[f.path for f in self.selected])
+                                     files=self.selectedItems())
         if Gdk.keyval_name(event.keyval) == "Return":
             self.manager.raiseSignal("file-activated",
-                                     files=[f.path for f in self.selected])
+                                     files=self.selectedItems())
         return True
+
+    def selectedItems(self):
+        """Returns paths of the selected files in directory order."""
+        return [self.items[i].path for i in sorted(self.selected)]
         
 class DirFrame(plugins.Plugin):
     """dirFrame shows the content of a directory in the center area.
@@ -346,6 +542,8 @@ class DirFrame(plugins.Plugin):
        # self.addResponse("file-select", self.onFileSelect)
        # self.addResponse("file-activate", self.onFileActivate)
         self.addResponse("change-dir", self.onChangeDir)
+        self.addResponse("dir-entries-changed", self.onDirEntriesChanged)
+        self.addResponse("quitting", self.onQuit)
         self.respondBefore["started"].append("dirTree")
         self.respondAfter["started"].append("guiManager")
         self.respondAfter["started"].append("settings")
@@ -353,12 +551,29 @@ class DirFrame(plugins.Plugin):
     def onStart(self, signal, *args, **kwargs):
         """Create the frame unpopulated."""
         self.manager.raiseSignal("request-settings", widget=self)
-        if "thumbnail-size" not in self.settings.keys():
-            self.manager.raiseSignal("set-new-setting", name="thumbnail-size",
-                                     setting = ThumbnailSizeSetting())        
+        with self.settings.transaction():
+            if "thumbnail-size" not in self.settings.keys():
+                self.manager.raiseSignal("set-new-setting",
+                                         name="thumbnail-size",
+                                         setting = ThumbnailSizeSetting())
+            if "thumbnail-workers" not in self.settings.keys():
+                self.manager.raiseSignal("set-new-setting",
+                                         name="thumbnail-workers",
+                                         setting = ThumbnailWorkersSetting())
+            if "thumbnail-cache-size" not in self.settings.keys():
+                self.manager.raiseSignal("set-new-setting",
+                                         name="thumbnail-cache-size",
+                                         setting = ThumbnailCacheSizeSetting())
         self.thumbnailSize = self.settings["thumbnail-size"].value
+        pixbufCache.setBudget(self.settings["thumbnail-cache-size"].value)
+        workers = self.settings["thumbnail-workers"].value
+        self.thumbnailService = ThumbnailService(workers)
+        self.placeholder = loadDefaultIcon(self.thumbnailSize)
         self.spacing = 30
         self.path = None
+        self.scanner = None
+        # Paths changed while the scanner is running
+        self.changedPaths = set()
         never = Gtk.PolicyType.NEVER
         self.scroll = Gtk.ScrolledWindow(hscrollbar_policy=never)
         self.holder = Gtk.Box(orientation = Gtk.Orientation.VERTICAL)
@@ -370,10 +585,16 @@ class DirFrame(plugins.Plugin):
         self.mainDirTitle.set_alignment(0, 1)
         separator = Gtk.HSeparator()
         self.grid = MainDirGrid(self.settings, self.manager,
-                                self.thumbnailSize + self.spacing)
-        self.grid.set_column_spacing(self.spacing)
+                                self.thumbnailService, self.thumbnailSize,
+                                self.placeholder,
+                                self.thumbnailSize + self.spacing,
+                                self.thumbnailSize + 2 * self.spacing)
+        self.grid.set_vadjustment(self.scroll.get_vadjustment())
         self.grid.set_can_focus(True)
+        self.spinner = Gtk.Spinner()
+        self.spinner.set_no_show_all(True)
         self.titleBox.pack_start(self.mainDirTitle, False, False, 0)
+        self.titleBox.pack_end(self.spinner, False, False, 20)
         self.holder.add(self.titleBox)
         self.holder.add(separator)        
         self.holder.add(self.grid)
@@ -382,43 +603,94 @@ class DirFrame(plugins.Plugin):
         self.grid.show()
 
     def onChangeDir(self, signal, *args, **kwargs):
-        showHidden = self.settings["show-hidden"].value
+        """Shows the files of kwargs["newPath"]. The directory is listed
+        in the background, a scan still running for the previous
+        directory is dropped."""
         newPath = kwargs["newPath"]
         try:
             title = newPath.split("/")[-1]
         except:
             title = "Root directory"
         self.mainDirTitle.set_markup("<big>{}</big>".format(title))
-        toadd = []
-        toShow = os.listdir(newPath)
-        if not showHidden:
-            toShow = filter(lambda f: not isHidden(f) , toShow)
-        fullPaths = [os.path.join(newPath, f) for f in toShow]
-        files = list(filter(os.path.isfile, fullPaths))
-        files.sort()
+        if self.path is not None:
+            self.manager.raiseSignal("unwatch-dir", path=self.path)
+        self.path = newPath
+        self.manager.raiseSignal("watch-dir", path=newPath)
+        self.grid.set_items([])
+        self.changedPaths = set()
+        self.scroll.get_vadjustment().set_value(0)
+        self.thumbnailService.cancelAll()
+        self.scan()
 
-        self.cursor_at = None
-        self.secondary_cursor_at = None
-        self.selected = []
-        for child in self.grid.get_children():
-            self.grid.remove(child.get_child())        
-        # Loading thumbnails can take too long on  some directories
-        # (like with lots of HD photos), so the process is divided
-        # into chunks and after each chunk pending events are handled
-        spinner = Gtk.Spinner()
-        spinner.start()
-        self.titleBox.pack_end(spinner, False, False, 20)
-        self.titleBox.show_all()
-        while Gtk.events_pending():
-            Gtk.main_iteration()
-        for chunk in chunks(files, 10):
-            for f in chunk:
-                w = FileWidget(f, self.thumbnailSize, 10)
-                self.grid.add(w)
-                self.grid.show_all()
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-        self.titleBox.remove(spinner)
+    def scan(self):
+        """Starts listing self.path into the grid."""
+        if self.scanner is not None:
+            self.scanner.cancel()
+        self.spinner.start()
+        self.spinner.show()
+        showHidden = self.settings["show-hidden"].value
+        self.scanner = DirScanner(self.path, self.onScanBatch,
+                                  self.onScanDone, showHidden=showHidden,
+                                  kind="files", onStat=self.onScanStat)
+        self.scanner.start()
+
+    def onScanBatch(self, scanner, entries):
+        """Adds a batch of files listed by scanner to the grid."""
+        self.grid.append_items(entries)
+
+    def onScanStat(self, scanner, entries):
+        """Takes the stat'ed entries of a listing that wasn't cached in
+        place of the ones shown without size and mtime."""
+        paths = [e.path for e in entries]
+        if paths == [e.path for e in self.grid.items]:
+            self.grid.replace_items(entries)
+        else:
+            # the directory changed between listing and stat'ing
+            self.grid.update_items(entries, key=lambda e: e.path)
+
+    def onScanDone(self, scanner, error):
+        """Hides the spinner once scanner has listed every file, and
+        applies the changes reported while it was running."""
+        self.scanner = None
+        self.spinner.stop()
+        self.spinner.hide()
+        if self.changedPaths:
+            self.applyChanges(self.changedPaths)
+            self.changedPaths = set()
+
+    def onDirEntriesChanged(self, signal, *args, **kwargs):
+        """Applies the changes of the directory shown to the grid. While
+        the directory is being listed, the changes are kept until the
+        listing is done, as it may be outdated."""
+        if kwargs["path"] != self.path:
+            return
+        changed = set(kwargs["added"] + kwargs["modified"] + kwargs["removed"])
+        if self.scanner is not None:
+            self.changedPaths.update(changed)
+        else:
+            self.applyChanges(changed)
+
+    def applyChanges(self, changed):
+        """Updates the grid items of the paths in changed, stat'ing each
+        of them. The other files keep their widgets, thumbnails and
+        selection."""
+        showHidden = self.settings["show-hidden"].value
+        entries = [e for e in self.grid.items if e.path not in changed]
+        for path in changed:
+            entry = dirCache.statEntry(path)
+            if (entry is not None and entry.isFile()
+                    and (showHidden or not isHidden(path))):
+                entries.append(entry)
+        entries.sort(key=lambda e: e.name)
+        self.grid.update_items(entries, key=lambda e: e.path)
+
+    def onQuit(self, signal, *args, **kwargs):
+        """Drops the queued thumbnails and kills the running
+        thumbnailers, which are not recorded as failed."""
+        if self.scanner is not None:
+            self.scanner.cancel()
+        self.thumbnailService.cancelAll()
+        thumbnailers.executor.shutdown()
 
 def createPlugin(manager):
     return DirFrame(manager)    
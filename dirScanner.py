@@ -0,0 +1,128 @@
+"""
+dirScanner
+
+Lists directories in a background thread and hands the entries over to
+the GTK main loop in batches, so that slow file systems or huge
+directories don't block the gui. Listings come from dirCache, so
+unchanged directories are not scanned again. Directories not in the
+cache are delivered as soon as their names are listed, the entries are
+stat'ed for the cache afterwards.
+"""
+
+import os
+from threading import Thread, Event
+
+from gi.repository import GLib
+
+import dirCache
+
+
+def isHidden(path):
+    """Returns whether file at the given path is hidden."""
+    (_, fname) = os.path.split(path)
+    return (fname[0]=="." or fname[-1]=="~")
+
+class DirScanner(object):
+    """Lists a directory in a worker thread. The dirCache.DirEntries,
+    sorted by name, are passed to onBatch(scanner, entries) in chunks
+    of batchSize from the main loop, followed by a single call of
+    onDone(scanner, error). If the listing wasn't cached, the entries
+    passed to onBatch have no size and mtime, and the stat'ed entries
+    are passed to onStat(scanner, entries) before onDone. A cancelled
+    scanner calls none of them."""
+
+    def __init__(self, path, onBatch, onDone=None, showHidden=False,
+                 kind=None, batchSize=200, onStat=None):
+        """Creates a DirScanner object.
+        Args
+            path: Directory to scan.
+            onBatch: Called with the scanner and a list of DirEntries.
+            onDone: Called with the scanner and the OSError raised while
+            scanning or None.
+            showHidden: Whether hidden entries are listed.
+            kind: "files", "dirs" or None for both.
+            batchSize: Maximum number of entries passed to onBatch.
+            onStat: Called with the scanner and all the stat'ed
+            DirEntries, if the listing wasn't cached."""
+        self.path = path
+        self.onBatch = onBatch
+        self.onDone = onDone
+        self.onStat = onStat
+        self.showHidden = showHidden
+        self.kind = kind
+        self.batchSize = batchSize
+        self.cancelled = Event()
+        self.thread = Thread(target=self.scan, daemon=True)
+
+    def start(self):
+        """Starts scanning."""
+        self.thread.start()
+
+    def cancel(self):
+        """Stops the scan. Batches not delivered yet are dropped."""
+        self.cancelled.set()
+
+    def isCancelled(self):
+        """Returns whether the scan has been cancelled."""
+        return self.cancelled.is_set()
+
+    def accepts(self, entry):
+        """Returns whether entry, a dirCache.DirEntry, is to be listed."""
+        if not self.showHidden and isHidden(entry.name):
+            return False
+        if self.kind == "files":
+            return entry.isFile()
+        if self.kind == "dirs":
+            return entry.isDir()
+        return True
+
+    def scan(self):
+        """Lists the directory, runs in the worker thread."""
+        cache = dirCache.getCache()
+        error = None
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            entries = cache.lookup(self.path, mtime)
+            if entries is None:
+                # Names first, stat'ing each entry is slow on large
+                # directories and network file systems
+                entries = dirCache.scanTypes(self.path, self.cancelled)
+                if entries is None:
+                    return
+                self.queueBatches(entries)
+                entries = cache.statListing(self.path, mtime, entries,
+                                            self.cancelled)
+                if entries is None:
+                    return
+                GLib.idle_add(self.deliverStat,
+                              [e for e in entries if self.accepts(e)])
+            else:
+                self.queueBatches(entries)
+        except OSError as e:
+            error = e
+        GLib.idle_add(self.deliverDone, error)
+
+    def queueBatches(self, entries):
+        """Queues the accepted entries for onBatch in chunks."""
+        entries = [e for e in entries if self.accepts(e)]
+        for i in range(0, len(entries), self.batchSize):
+            GLib.idle_add(self.deliverBatch, entries[i:i+self.batchSize])
+
+    def deliverBatch(self, entries):
+        """Passes entries to onBatch, runs in the main loop."""
+        if not self.cancelled.is_set():
+            self.onBatch(self, entries)
+        return False
+
+    def deliverStat(self, entries):
+        """Passes the stat'ed entries to onStat, runs in the main
+        loop."""
+        if not self.cancelled.is_set() and self.onStat is not None:
+            self.onStat(self, entries)
+        return False
+
+    def deliverDone(self, error):
+        """Calls onDone, runs in the main loop."""
+        if not self.cancelled.is_set() and self.onDone is not None:
+            self.onDone(self, error)
+        return False
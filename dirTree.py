@@ -1,10 +1,16 @@
 import os
-from os.path import join, split, expanduser, isdir
-from gi.repository import Gtk, Gdk, Pango
+from os.path import split, expanduser, isdir
+import warnings
+import bisect
+import itertools
+from threading import Thread
+from queue import PriorityQueue
+from gi.repository import Gtk, Gdk, Gio, GLib, GObject, Pango
 import cairo
 
 import settings
 import plugins
+import dirCache
 
 
 def isHidden(path):
@@ -12,17 +18,36 @@ def isHidden(path):
     (_, fname) = os.path.split(path)
     return (fname[0]=="." or fname[-1]=="~")
 
-def breakPath(path):
-    """ Breaks path into an array. 
-    Example: path= /home/anon/Documents returns:
-    ["home", "anon", "Documents"].
-    This is different from path.split("/") as it is cross platform"""    
-    #TODO test on windows
-    (head, tail) = os.path.split(path)
-    if len(head) == 1:
-        return [tail]
+def hasSubdirs(path, showHidden):
+    """Returns whether directory at path has subdirectories. Listing
+    stops at the first one, and types come from d_type, so entries are
+    not stat'ed on most file systems."""
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if (entry.is_dir() and
+                        (showHidden or not isHidden(entry.name))):
+                    return True
+    except OSError:
+        pass
+    return False
+
+def listSubdirs(path, showHidden):
+    """Returns the sorted paths of subdirectories of path. An up to
+    date dirCache listing is used if there is one, otherwise the
+    directory is listed with os.scandir without stat'ing entries."""
+    entries = dirCache.getCache().cachedListdir(path)
+    if entries is not None:
+        dirs = [e.path for e in entries if e.isDir()]
     else:
-        return breakPath(head) + [tail]
+        try:
+            with os.scandir(path) as entries:
+                dirs = sorted(e.path for e in entries if e.is_dir())
+        except OSError:
+            dirs = []
+    if not showHidden:
+        dirs = [d for d in dirs if not isHidden(d)]
+    return dirs
 
 class DirRowHeightSetting(settings.Setting):
     "Setting for height of DirRow's"""
@@ -56,6 +81,10 @@ class StartPathSetting(settings.DirPathSetting):
         """Sets starting path to home directory of the user."""
         self.value = expanduser("~")
 
+settings.registerSetting("dir-row-height", DirRowHeightSetting)
+settings.registerSetting("start-path", StartPathSetting)
+settings.registerSetting("show-hidden", settings.BooleanSetting)
+
 """class DirRowNormalColorSetting(settings.GdkColorSetting):
     
     def __init__(self):
@@ -66,119 +95,302 @@ class DirNowActiveColorSetting(settings.GdkColorSetting):
     def __init__(self):
         settings.GdkColorSetting.__init__(self, "#d0d0d0")"""
 
-class DirRow(Gtk.ListBoxRow):
-    """ListBoxRow for showing directories and toggling children on and off"""
+# Colors of DirRows, installed once for the screen by DirTree
+DIR_ROW_CSS = b"""
+row.dir-row { background-color: #d7dad7; }
+row.dir-row:active, row.dir-row:selected { background-color: #d0d0d0; }
+row.dir-row.selected-dir { background-color: #888a85; }
+"""
 
-    def __init__(self, path, plugin, depth):
-        """Creates DirRowObject
+class DirNode(GObject.Object):
+    """A directory in the tree model of dirTree. The nodes shown are
+    kept in a flat Gio.ListStore in display order, so the subtree of a
+    node is toggled with a single splice of the store."""
+
+    def __init__(self, path, plugin, depth, parent=None):
+        """Creates DirNode object and adds it to the path index of
+        plugin.
         Args
-            path: Full path to directory DirRow shows.
-            plugin: dirTree plugin DirRow belongs to. It is used for
-            getting settings.
-            depth: Relative indentation depth of directory"""
-        Gtk.ListBoxRow.__init__(self)
+            path: Full path to directory DirNode stands for.
+            plugin: dirTree plugin DirNode belongs to. It is used for
+            getting settings and the store.
+            depth: Relative indentation depth of directory
+            parent: DirNode of the parent directory, None for root."""
+        GObject.Object.__init__(self)
         self.isSelected = False
         self.isToggledOn = False
         self.isPopulated = False
+        # Whether the subdirectories are being listed by the worker
+        self.isListing = False
+        self.isProbed = False
+        # Whether the directory has subdirectories, None until probed
+        self.hasSubdirs = None
         self.children = []
+        # Paths of the children that don't have a node yet
+        self.pendingPaths = []
         self.plugin = plugin
         self.path = path
         self.depth = depth
+        self.parent = parent
         (_, self.display) = os.path.split(path)
-        self.display = self.depth*"  " + self.display
-        if "dir-row-height" not in self.plugin.settings.keys():
-            self.plugin.manager.raiseSignal("set-new-setting",
-                                          setting = DirRowHeightSetting(),
-                                          name="dir-row-height")
-        if "show-hidden" not in self.plugin.settings.keys():
-            self.plugin.manager.raiseSignal("set-new-setting",
-                                            setting=settings.BooleanSetting(),
-                                            name="show-hidden")
-        height = self.plugin.settings["dir-row-height"].value
-        self.set_size_request(-1, height)
-        normalColor = Gdk.Color.parse("#d7dad7")[1]
-        activeColor = Gdk.Color.parse("#d0d0d0")[1]
-        self.modify_bg(Gtk.StateType.NORMAL, normalColor)
-        self.modify_bg(Gtk.StateType.ACTIVE, activeColor)
-        self.modify_bg(Gtk.StateType.SELECTED, activeColor)
-        self.label = Gtk.Label(self.display)
-        self.label.set_ellipsize(Pango.EllipsizeMode.END)
-        self.label.set_alignment(0, 0.5)
-        #This somehow makes ellipsize work
-        self.label.set_max_width_chars(1)
-        self.connect("key-press-event", self.plugin.onKeyEvent)
-        self.add(self.label)
-        self.show_all()
+        plugin.nodes[path] = self
+        # DirRow showing the node while it is in the store
+        self.row = None
 
-    def deselect(self):
-        """Deselects the row and reverts colors to normal."""
-        normalColor = Gdk.Color.parse("#d7dad7")[1]
-        activeColor = Gdk.Color.parse("#d0d0d0")[1]
-        self.modify_bg(Gtk.StateType.NORMAL, normalColor)
-        self.modify_bg(Gtk.StateType.ACTIVE, activeColor)
-        self.modify_bg(Gtk.StateType.SELECTED, activeColor)
-        self.set_state(Gtk.StateType.NORMAL)      
+    def isShown(self):
+        """Returns whether the node is in the tree's store."""
+        return self.row is not None
+
+    def index(self):
+        """Returns the position of the node in the store."""
+        return self.row.get_index()
+
+    def visibleNodes(self):
+        """Returns the node and its descendants that are shown while
+        it is, in display order."""
+        nodes = [self]
+        if self.isToggledOn:
+            for child in self.children:
+                nodes.extend(child.visibleNodes())
+        return nodes
+
+    def lastIndex(self):
+        """Returns the store index of the last node shown for the
+        subtree of this node."""
+        if self.isToggledOn and self.children:
+            return self.children[-1].lastIndex()
+        return self.index()
+
+    def hasChildren(self):
+        """Returns whether the directory has subdirectories, None if
+        it is not known yet."""
+        if self.isPopulated:
+            return bool(self.children or self.pendingPaths)
+        return self.hasSubdirs
+
+    def onMap(self):
+        """Queues probing for subdirectories once the node is shown."""
+        if not self.isProbed:
+            self.isProbed = True
+            self.plugin.queueProbe(self)
+
+    def onProbed(self, result):
+        """Receives whether the directory has subdirectories, as found
+        by the worker thread."""
+        if not self.isPopulated:
+            self.hasSubdirs = result
+        self.updateRow()
+
+    def updateRow(self):
+        """Updates the expander of the row showing the node."""
+        if self.row is not None:
+            self.row.updateExpander()
 
     def select(self):
-        """Selects row and changes its color."""
-        selectedColor = Gdk.Color.parse("#888a85")[1]
-        self.modify_bg(Gtk.StateType.NORMAL, selectedColor)
-        self.modify_bg(Gtk.StateType.ACTIVE, selectedColor)
-        self.modify_bg(Gtk.StateType.SELECTED, selectedColor)
+        """Selects the node."""
+        self.isSelected = True
+        if self.row is not None:
+            self.row.select()
+
+    def deselect(self):
+        """Deselects the node."""
+        self.isSelected = False
+        if self.row is not None:
+            self.row.deselect()
 
     def toggle(self):
-        """Toggles row."""
+        """Toggles node."""
         if self.isToggledOn:
             self.isToggledOn = False
             self.toggleOff()
         else:
             self.isToggledOn = True
             self.toggleOn()  
+        self.updateRow()
             
     def toggleOn(self):
-        """Toggles on the row. This doesn't effect isToggledOn property,
-        but only handles the gui changes. Children of the row will be
-        added if not already."""
-        if not self.isPopulated:
-            self.populate()
-        index = self.get_index() + 1            
+        """Toggles on the node. This doesn't effect isToggledOn property,
+        but only handles the gui changes. Children of the node will be
+        added if not already, listed by the worker thread and created in
+        batches on idle."""
+        if not self.isPopulated and not self.isListing:
+            self.isListing = True
+            self.plugin.runInWorker(listSubdirs,
+                                    (self.path, self.plugin.showHidden),
+                                    self.onListed)
+        nodes = []
         for child in self.children:
-            self.plugin.widget.insert(child, index)
-            if child.isToggledOn:
-                index = child.toggleOn()
-            index += 1
-        return index-1          
+            nodes.extend(child.visibleNodes())
+        self.plugin.store.splice(self.index() + 1, 0, nodes)
 
     def toggleOff(self):
-        """Toggles on the row. This doesn't effect isToggledOn property,
-        but only handles the gui changes. Children of the row will be
-        added if not already."""    
-        for child in self.children:
-            self.plugin.widget.remove(child)
-            child.toggleOff()
-        #self.children = []
+        """Toggles off the node. This doesn't effect isToggledOn
+        property, but only handles the gui changes."""
+        count = sum(len(child.visibleNodes()) for child in self.children)
+        self.plugin.store.splice(self.index() + 1, count, [])
         
+    def applyChanges(self, added, removed):
+        """Adds nodes for the new subdirectories in added and drops the
+        nodes of the paths in removed, leaving other nodes untouched."""
+        removed = set(removed)
+        self.pendingPaths = [p for p in self.pendingPaths
+                             if p not in removed]
+        for child in [c for c in self.children if c.path in removed]:
+            if child.isShown():
+                self.plugin.store.splice(child.index(),
+                                         len(child.visibleNodes()), [])
+            self.children.remove(child)
+            self.plugin.forgetNode(child)
+        showHidden = self.plugin.showHidden
+        paths = [c.path for c in self.children]
+        for path in sorted(added):
+            if (path in paths or path in self.pendingPaths or not isdir(path)
+                    or (not showHidden and isHidden(path))):
+                continue
+            if self.pendingPaths and (not paths or path > paths[-1]):
+                # its node is created with the other listed children
+                bisect.insort(self.pendingPaths, path)
+                continue
+            node = DirNode(path=path, plugin=self.plugin, depth=self.depth+1,
+                           parent=self)
+            i = bisect.bisect(paths, path)
+            paths.insert(i, path)
+            self.children.insert(i, node)
+            if self.isToggledOn and self.isShown():
+                if i > 0:
+                    index = self.children[i-1].lastIndex() + 1
+                else:
+                    index = self.index() + 1
+                self.plugin.store.insert(index, node)
+        self.updateRow()
+
+    def listChildren(self):
+        """Lists the subdirectories, their nodes are created by
+        createChildren."""
+        self.setListing(listSubdirs(self.path, self.plugin.showHidden))
+
+    def setListing(self, paths):
+        """Takes paths, the sorted subdirectories, as the children to
+        create and watches the directory."""
+        self.pendingPaths = paths
+        self.isPopulated = True
+        self.plugin.watchNode(self)
+        self.updateRow()
+
+    def onListed(self, paths):
+        """Receives the subdirectories listed by the worker thread and
+        creates their nodes in batches on idle. Nothing is done if the
+        listing failed, or if the node was populated meanwhile or dropped
+        from the tree."""
+        self.isListing = False
+        if (paths is None or self.isPopulated
+                or self.plugin.nodes.get(self.path) is not self):
+            return
+        self.setListing(paths)
+        GLib.idle_add(self.createChildrenBatch)
+
+    def createChildren(self, count):
+        """Creates nodes for up to count listed subdirectories, showing
+        them if the node is toggled on. Returns whether subdirectories
+        without a node are left."""
+        paths = self.pendingPaths[:count]
+        self.pendingPaths = self.pendingPaths[count:]
+        nodes = [DirNode(path=path, plugin=self.plugin, depth=self.depth+1,
+                         parent=self)
+                 for path in paths]
+        if self.isToggledOn and self.isShown():
+            self.plugin.store.splice(self.lastIndex() + 1, 0, nodes)
+        self.children.extend(nodes)
+        return bool(self.pendingPaths)
+
+    def createChildrenBatch(self):
+        """Idle callback creating the next batch of child nodes. Stops
+        if the node was dropped from the tree meanwhile."""
+        if self.plugin.nodes.get(self.path) is not self:
+            return False
+        return self.createChildren(50)
+
     def populate(self):
-        """Adds children to row. In order to update the row, use the
-        repopulate function. """
-        showHidden = self.plugin.settings["show-hidden"].value
-        paths = [join(self.path, path) for path in os.listdir(self.path)]
-        paths.sort()
-        dirs = filter(os.path.isdir, paths)
-        if not showHidden:
-            dirs = filter(lambda f: not isHidden(f) , dirs)
-        for path in dirs:
-            row = DirRow(path=os.path.join(self.path, path), 
-                         plugin=self.plugin, depth=self.depth+1)
-            self.children.append(row)
-        self.isPopulated = True      
-        
+        """Adds children to node at once. In order to update the node,
+        use the repopulate function. """
+        if not self.isPopulated:
+            self.listChildren()
+        self.createChildren(len(self.pendingPaths))      
+
+class DirRow(Gtk.ListBoxRow):
+    """ListBoxRow showing a DirNode. Rows are created by the ListBox
+    for the nodes in the store and destroyed once they leave it."""
+
+    def __init__(self, node):
+        """Creates DirRowObject
+        Args
+            node: DirNode the row shows."""
+        Gtk.ListBoxRow.__init__(self)
+        self.node = node
+        self.plugin = node.plugin
+        self.set_size_request(-1, self.plugin.rowHeight)
+        style = self.get_style_context()
+        style.add_class("dir-row")
+        if node.isSelected:
+            style.add_class("selected-dir")
+        self.label = Gtk.Label(node.display)
+        self.label.set_ellipsize(Pango.EllipsizeMode.END)
+        self.label.set_alignment(0, 0.5)
+        #This somehow makes ellipsize work
+        self.label.set_max_width_chars(1)
+        # Shows whether the directory has subdirectories once probed
+        self.expander = Gtk.Image()
+        self.expander.set_size_request(16, -1)
+        self.expander.set_margin_left(node.depth * 12)
+        self.updateExpander()
+        box = Gtk.Box(spacing=4)
+        box.pack_start(self.expander, False, False, 0)
+        box.pack_start(self.label, True, True, 0)
+        self.connect("key-press-event", self.plugin.onKeyEvent)
+        self.connect("map", self.onMap)
+        self.connect("destroy", self.onDestroy)
+        self.add(box)
+        self.show_all()
+
+    def onMap(self, widget):
+        """Lets the node probe for subdirectories once it is shown."""
+        self.node.onMap()
+
+    def onDestroy(self, widget):
+        """Detaches the row from its node."""
+        if self.node.row is self:
+            self.node.row = None
+
+    def updateExpander(self):
+        """Shows an arrow if the node has children, pointing down if it
+        is toggled on."""
+        if not self.node.hasChildren():
+            self.expander.clear()
+        elif self.node.isToggledOn:
+            self.expander.set_from_icon_name("pan-down-symbolic",
+                                             Gtk.IconSize.MENU)
+        else:
+            self.expander.set_from_icon_name("pan-end-symbolic",
+                                             Gtk.IconSize.MENU)
+
+    def deselect(self):
+        """Reverts colors to normal."""
+        self.get_style_context().remove_class("selected-dir")
+        self.set_state(Gtk.StateType.NORMAL)      
+
+    def select(self):
+        """Changes colors to show the row is selected."""
+        self.get_style_context().add_class("selected-dir")
+
 class DirTree(plugins.Plugin):
     """dirTree provides a gui in the left pane to browser directories.
     One can toggle the subdirectories of a directory by space key or 
     a single click. Enter key or double click selects the directory 
     and raises "change-dir" signal."""
 
+    # Gtk.CssProvider with the colors of DirRows
+    styleProvider = None
+
     def __init__(self, manager):
         """Creates a DirTree object."""
         plugins.Plugin.__init__(self, manager)
@@ -187,41 +399,81 @@ class DirTree(plugins.Plugin):
         self.dependencies.append("guiManager")   
         self.addResponse("started", self.onStart)
         self.addResponse("change-dir", self.onChangeDir)
+        self.addResponse("dir-entries-changed", self.onDirEntriesChanged)
         self.respondAfter["started"].append("settings")
         self.respondAfter["started"].append("guiManager")
+        # path: DirNode, every node of the tree
+        self.nodes = {}
+        # path: populated DirNode, these are watched for changes
+        self.watchedNodes = {}
+        # (priority, counter, function, args, callback) for the worker
+        self.jobs = PriorityQueue()
+        self.jobCounter = itertools.count()
+        self.worker = None
         
     def onStart(self, signal, *args, **kwargs):
         """Creates the tree with start-path setting as root."""
         self.manager.raiseSignal("request-settings", widget=self)    
+        # DirNodes shown, in display order
+        self.store = Gio.ListStore.new(DirNode)
         self.widget = Gtk.ListBox()
         self.widget.set_selection_mode(Gtk.SelectionMode.SINGLE)
         self.widget.set_activate_on_single_click(False)
         self.widget.connect("button-press-event", self.onMouseEvent)
-        self.selectedRow = None
+        self.widget.bind_model(self.store, self.createRow)
+        self.selectedNode = None
         self.manager.raiseSignal("request-place-left-pane", widget=self.widget)
-        if "start-path" not in self.settings.keys():
-            self.manager.raiseSignal("set-new-setting", name="start-path",
-                                     setting = StartPathSetting())
-        if "show-hidden " not in self.settings.keys():
-            self.manager.raiseSignal("set-new-setting", name="show-hidden",
-                                     setting = settings.BooleanSetting())
+        with self.settings.transaction():
+            if "start-path" not in self.settings.keys():
+                self.manager.raiseSignal("set-new-setting", name="start-path",
+                                         setting = StartPathSetting())
+            if "show-hidden" not in self.settings.keys():
+                self.manager.raiseSignal("set-new-setting",
+                                         name="show-hidden",
+                                         setting = settings.BooleanSetting())
+            if "dir-row-height" not in self.settings.keys():
+                self.manager.raiseSignal("set-new-setting",
+                                         name="dir-row-height",
+                                         setting = DirRowHeightSetting())
+        # Resolved once, rows and nodes use these
+        self.rowHeight = self.settings["dir-row-height"].value
+        self.showHidden = self.settings["show-hidden"].value
+        self.addStyle()
         startpath = self.settings["start-path"].value
         self.root = startpath
-        row = DirRow(path=self.root, plugin=self, depth=0)
-        self.widget.add(row)
-        row.toggle()
+        self.rootNode = DirNode(path=self.root, plugin=self, depth=0)
+        self.store.append(self.rootNode)
+        self.rootNode.toggle()
         self.widget.show_all()  
-        self.manager.raiseSignal("change-dir", newPath = startpath)
+        self.manager.postSignal("change-dir", newPath = startpath)
+
+    def addStyle(self):
+        """Installs the CSS of DirRows for the screen, once per
+        process."""
+        if DirTree.styleProvider is not None:
+            return
+        DirTree.styleProvider = Gtk.CssProvider()
+        DirTree.styleProvider.load_from_data(DIR_ROW_CSS)
+        Gtk.StyleContext.add_provider_for_screen(
+            Gdk.Screen.get_default(), DirTree.styleProvider,
+            Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+
+    def createRow(self, node):
+        """Creates the DirRow showing node, called by the ListBox."""
+        node.row = DirRow(node)
+        return node.row
         
     def onMouseEvent(self, widget, event):
         """Responds to button press events.
         Single click: toggle directory
         Double click: select directory"""
         row = self.widget.get_row_at_y(event.y)
+        if row is None:
+            return
         if event.type == Gdk.EventType.DOUBLE_BUTTON_PRESS:
-            self.select(row)
+            self.select(row.node)
         elif event.type == Gdk.EventType.BUTTON_PRESS:
-            row.toggle()
+            self.toggle(row.node)
      
     def onKeyEvent(self, row, event):
         """Responds to key press events.
@@ -230,54 +482,130 @@ class DirTree(plugins.Plugin):
         """
         keyname = Gdk.keyval_name(event.keyval)
         if keyname == "Return":
-            self.select(row)
+            self.select(row.node)
         elif keyname == "space":
-            row.toggle()
+            self.toggle(row.node)
+
+    def toggle(self, node):
+        """Toggles node for the user. Thumbnails under a directory the
+        user expands are prewarmed, nodes toggled by the program, like
+        the root or the ancestors revealed, are not."""
+        node.toggle()
+        if node.isToggledOn:
+            self.manager.raiseSignal("prewarm-thumbnails", path=node.path)
 
     def onChangeDir(self, signal, *args, **kwargs):
         """Selects kwargs[“newPath”] if it is in dirTree."""
         newPath = kwargs["newPath"]
-        rows = self.widget.get_children()        
-        if self.selectedRow is not None:
-            if self.selectedRow.path == newPath: #nothing to do
+        if self.selectedNode is not None:
+            if self.selectedNode.path == newPath: #nothing to do
                 return            
-            self.selectedRow.deselect()
-            self.selectedRow = None   
-        root = breakPath(self.root)
-        target = breakPath(newPath)
-        if (len(target) < len(root) or target[:len(root)] != root ):
-            return #target not in tree, nothing to do
-        if newPath == self.root:
-            self.selectedRow = rows[0]
-            self.selectedRow.select()
-            return
-        index = len(root)
-        found = join(self.root, target[index])
-        try:
-            targetRow = list(filter(lambda row: row.path == found, rows))[0]
-        except:
-            return
-        index += 1
-        while index < len(target):
-            found = join(found, target[index])
-            if not targetRow.isToggledOn:
-                targetRow.toggle()
-            for child in targetRow.children:
-                if child.path == found:
-                    targetRow = child
-                    break
-            index += 1
-        if targetRow.path == newPath:
-            targetRow.select()
-            self.selectedRow = targetRow
+            self.selectedNode.deselect()
+            self.selectedNode = None   
+        targetNode = self.reveal(os.path.normpath(newPath))
+        if targetNode is not None:
+            targetNode.select()
+            self.selectedNode = targetNode
+
+    def reveal(self, path):
+        """Returns the DirNode of path with its ancestors toggled on,
+        None if path is not in the tree. Only the ancestors of path are
+        populated, and the ones shown by toggling are added to the
+        store with a single splice."""
+        # Paths of the ancestors without a node, deepest first
+        missing = []
+        while path not in self.nodes:
+            (parent, _) = os.path.split(path)
+            if parent == path:
+                return None #path not in tree
+            missing.append(path)
+            path = parent
+        node = self.nodes[path]
+        for path in reversed(missing):
+            node.populate()
+            node = self.nodes.get(path)
+            if node is None:
+                return None
+        # Ancestors shown once the topmost collapsed one is toggled on
+        # are only marked, their nodes go in with its splice.
+        collapsed = None
+        ancestor = node.parent
+        while ancestor is not None:
+            if not ancestor.isToggledOn:
+                ancestor.populate()
+                if collapsed is not None:
+                    collapsed.isToggledOn = True
+                collapsed = ancestor
+            ancestor = ancestor.parent
+        if collapsed is not None:
+            collapsed.toggle()
+        return node
             
-    def select(self, row):
-        """Selects row and deselects the old one."""
-        if self.selectedRow is not None:
-            self.selectedRow.deselect()
-        self.selectedRow = row
-        row.select()
-        self.manager.raiseSignal("change-dir", newPath = row.path)
+    def queueProbe(self, node):
+        """Probes node for subdirectories in the worker thread, after
+        the listings asked for by expanding nodes."""
+        self.runInWorker(hasSubdirs, (node.path, self.showHidden),
+                         node.onProbed, priority=1)
+
+    def runInWorker(self, function, args, callback, priority=0):
+        """Calls function(*args) in the worker thread, so that slow file
+        systems don't block the gui, and callback(result) from the main
+        loop. Jobs with lower priority values are run first."""
+        self.jobs.put((priority, next(self.jobCounter), function, args,
+                       callback))
+        if self.worker is None:
+            self.worker = Thread(target=self.work, daemon=True)
+            self.worker.start()
+
+    def work(self):
+        """Main loop of the worker thread. A job that raises passes None
+        to its callback, so the worker keeps running later jobs."""
+        while True:
+            (_, _, function, args, callback) = self.jobs.get()
+            try:
+                result = function(*args)
+            except Exception as e:
+                warnings.warn("{} failed: {!r}".format(function.__name__, e))
+                result = None
+            GLib.idle_add(self.deliver, callback, result)
+
+    def deliver(self, callback, result):
+        """Passes the result of a job to its callback, runs in the main
+        loop."""
+        callback(result)
+        return False
+
+    def watchNode(self, node):
+        """Watches the directory of a populated node for changes."""
+        self.watchedNodes[node.path] = node
+        self.manager.raiseSignal("watch-dir", path=node.path)
+
+    def forgetNode(self, node):
+        """Stops watching the directories of node and its descendants,
+        called when node is dropped from the tree."""
+        if self.selectedNode is node:
+            self.selectedNode = None
+        if self.nodes.get(node.path) is node:
+            del self.nodes[node.path]
+        if self.watchedNodes.get(node.path) is node:
+            del self.watchedNodes[node.path]
+            self.manager.raiseSignal("unwatch-dir", path=node.path)
+        for child in node.children:
+            self.forgetNode(child)
+
+    def onDirEntriesChanged(self, signal, *args, **kwargs):
+        """Updates the children of the node of kwargs["path"]."""
+        node = self.watchedNodes.get(kwargs["path"])
+        if node is not None:
+            node.applyChanges(kwargs["added"], kwargs["removed"])
+
+    def select(self, node):
+        """Selects node and deselects the old one."""
+        if self.selectedNode is not None:
+            self.selectedNode.deselect()
+        self.selectedNode = node
+        node.select()
+        self.manager.postSignal("change-dir", newPath = node.path)
                
 def createPlugin(manager):
     return DirTree(manager)
@@ -0,0 +1,115 @@
+"""
+dirWatcher
+
+dirWatcher plug-in watches directories for changes on request and
+reports them in batches.
+
+Signals:
+watch-dir: onWatchDir
+unwatch-dir: onUnwatchDir
+
+Raises:
+dir-entries-changed with path (the directory), added, removed and
+modified (lists of full paths).
+"""
+
+from gi.repository import Gio, GLib
+
+import plugins
+import dirCache
+
+class DirWatcher(plugins.Plugin):
+    """Watches directories with Gio.FileMonitor. Events are collected
+    for a short while and raised as a single dir-entries-changed per
+    directory, so that a directory getting thousands of files written
+    into it is reported a few times a second at most."""
+
+    def __init__(self, manager):
+        """Creates a DirWatcher object."""
+        plugins.Plugin.__init__(self, manager)
+        self.pname = "dirWatcher"
+        self.addResponse("watch-dir", self.onWatchDir)
+        self.addResponse("unwatch-dir", self.onUnwatchDir)
+        # path: [Gio.FileMonitor, number of watchers]
+        self.monitors = {}
+        # path: {path of entry: "added", "removed" or "modified"}
+        self.pending = {}
+        self.flushSource = None
+        # Milliseconds to collect events before raising them
+        self.delay = 200
+
+    def onWatchDir(self, signal, *args, **kwargs):
+        """Starts watching kwargs["path"]. Each watch-dir must be
+        followed by an unwatch-dir for the same path."""
+        path = kwargs["path"]
+        if path in self.monitors:
+            self.monitors[path][1] += 1
+            return
+        try:
+            monitor = Gio.File.new_for_path(path).monitor_directory(
+                Gio.FileMonitorFlags.WATCH_MOVES, None)
+        except GLib.Error:
+            return
+        monitor.connect("changed", self.onChanged, path)
+        self.monitors[path] = [monitor, 1]
+
+    def onUnwatchDir(self, signal, *args, **kwargs):
+        """Stops watching kwargs["path"] once no one watches it."""
+        path = kwargs["path"]
+        if path not in self.monitors:
+            return
+        self.monitors[path][1] -= 1
+        if self.monitors[path][1] == 0:
+            self.monitors.pop(path)[0].cancel()
+            self.pending.pop(path, None)
+
+    def onChanged(self, monitor, changedFile, otherFile, eventType, path):
+        """Collects an event of the monitor watching path."""
+        events = Gio.FileMonitorEvent
+        if eventType in (events.CREATED, events.MOVED_IN):
+            self.record(path, changedFile.get_path(), "added")
+        elif eventType in (events.DELETED, events.MOVED_OUT):
+            self.record(path, changedFile.get_path(), "removed")
+        elif eventType == events.RENAMED:
+            self.record(path, changedFile.get_path(), "removed")
+            self.record(path, otherFile.get_path(), "added")
+        elif eventType in (events.CHANGES_DONE_HINT,
+                           events.ATTRIBUTE_CHANGED):
+            self.record(path, changedFile.get_path(), "modified")
+        else:
+            return
+        if self.flushSource is None:
+            self.flushSource = GLib.timeout_add(self.delay, self.flush)
+
+    def record(self, path, entry, change):
+        """Merges change of entry with the changes pending for it."""
+        changes = self.pending.setdefault(path, {})
+        old = changes.get(entry)
+        if change == "added" and old == "removed":
+            change = "modified"
+        elif change == "removed" and old == "added":
+            del changes[entry]
+            return
+        elif change == "modified" and old == "added":
+            return
+        changes[entry] = change
+
+    def flush(self):
+        """Raises dir-entries-changed for the collected events."""
+        self.flushSource = None
+        pending = self.pending
+        self.pending = {}
+        for (path, changes) in pending.items():
+            if not changes:
+                continue
+            # Modified entries don't change the directory's mtime
+            dirCache.getCache().invalidate(path)
+            byKind = {"added": [], "removed": [], "modified": []}
+            for (entry, change) in changes.items():
+                byKind[change].append(entry)
+            self.manager.raiseSignal("dir-entries-changed", path=path,
+                                     **byKind)
+        return False
+
+def createPlugin(manager):
+    return DirWatcher(manager)
@@ -53,6 +53,9 @@ class WindowSizeSetting(settings.Setting):
         """ Sets window size to default."""
         self.set((650,480))
 
+settings.registerSetting("min_window_size", WindowSizeSetting)
+settings.registerSetting("pane_width", LeftPaneWidthSetting)
+
 class guiManager(plugins.Plugin):
     """guiManager creates a Gtk.Main window with a left pane
        (Gtk.ScrolledWindow), center area (Gtk.Stack) and a Gtk.HeaderBar.
@@ -66,6 +69,8 @@ class guiManager(plugins.Plugin):
        request-remove-left-pane: onLeftPaneRemoveRequest
        request-remove-center: onCenterRemoveRequest
        request-remove-header: onHeaderRemoveRequest
+       Raises quitting when the window is closed, before the main loop
+       stops.
        """
 
     def __init__(self, manager):
@@ -89,21 +94,24 @@ class guiManager(plugins.Plugin):
         """Creates the gui"""
         self.settings = None
         self.manager.raiseSignal("request-settings", widget=self)
-        if "min_window_size" not in self.settings.keys():
-            self.manager.raiseSignal("set-new-setting", 
-                                     name="min_window_size",
-                                     setting = WindowSizeSetting())
-        if "pane_width" not in self.settings.keys():
-            self.manager.raiseSignal("set-new-setting", 
-                                     name="pane_width",
-                                     setting = LeftPaneWidthSetting())        
+        with self.settings.transaction():
+            if "min_window_size" not in self.settings.keys():
+                self.manager.raiseSignal("set-new-setting", 
+                                         name="min_window_size",
+                                         setting = WindowSizeSetting())
+            if "pane_width" not in self.settings.keys():
+                self.manager.raiseSignal("set-new-setting", 
+                                         name="pane_width",
+                                         setting = LeftPaneWidthSetting())        
         (MIN_WIDTH, MIN_HEIGHT) = self.settings["min_window_size"].value
         LEFT_PANE_WIDTH = self.settings["pane_width"].value
             
         
         self.window = Gtk.Window()
         self.window.set_size_request(MIN_WIDTH, MIN_HEIGHT)
-        self.window.connect("delete-event", Gtk.main_quit)
+        self.window.connect("delete-event", self.onDelete)
+        if self.manager.profiler is not None:
+            self.firstDraw = self.window.connect("draw", self.onFirstDraw)
         self.window.add_events(Gdk.EventMask.KEY_PRESS_MASK)        
         self.window.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)        
         
@@ -133,6 +141,18 @@ class guiManager(plugins.Plugin):
         self.window.add(box)        
         self.window.show_all()
 
+    def onDelete(self, widget, event):
+        """Lets plug-ins stop their background work, then quits."""
+        self.manager.raiseSignal("quitting")
+        Gtk.main_quit()
+        return False
+
+    def onFirstDraw(self, widget, context):
+        """Marks the first time the window is drawn for the profiler."""
+        self.window.disconnect(self.firstDraw)
+        self.manager.profiler.mark("first-draw")
+        return False
+
     def onLeftPanePlaceRequest(self, signal, *args, **kwargs):
         """Places kwargs["widget"] on kwargs["side"] of leftPane, 
         kwargs["side"] being "top" or "bottom" with "top" as default."""
@@ -8,9 +8,7 @@ from os.path import isdir, isfile, join
 import urlparse
 import urllib
 
-import re
-
-from mimetypes import guess_type
+from thumbnailers import registry, executor
 # used to load and process images faster
 from PIL import Image
 import numpy
@@ -50,25 +48,6 @@ def pathToName(path):
         return path.split("/")[-1]
 
 
-def loadThumbnailers():
-    """Load thumbnailers
-    thumbnailer files should be saved in thumbnailersDir and must be written
-    in Gnome's thumbnailer entry format"""
-    thumbnailers = {}
-    thumbnailersDir = "/usr/share/thumbnailers/"
-    if isdir(thumbnailersDir):
-        for filename in os.listdir(thumbnailersDir):
-            command = ""
-            tFile = open(join(thumbnailersDir, filename), "r").readlines()
-            for line in tFile:
-                if line[:5] == "Exec=":
-                    command = line[5:]
-                if line[:9] == "MimeType=":
-                    for mime in line[9:].split(";"):
-                        thumbnailers[mime] = command
-    return thumbnailers
-
-
 def createPixbufThumbnail(pixbuf, size):
     """Creates a pixbuf thumbnail with given size and
     returns (thumbnail, width, height)"""
@@ -98,27 +77,24 @@ def createThumbnail(path):
     """Returns the thumbnail created for file at path (as numpy array,
     returna False if no thumbnail can be created"""
     fileName, ext = os.path.splitext(path)
-    thumbnailers = loadThumbnailers()
+    thumbnailer = registry.forPath(path)
     if ext.lower() in [".png", ".jpg", ".bmp", ".eps", ".gif", ".im", ".jpeg",
                        ".mps", ".pcx", ".ppm", ".tiff", ".webp", ".ico"]:
         try:
             image = Image.open(path)
         except:
             return False
+        # Let JPEG images decode at a reduced DCT scale
+        image.draft("RGB", (256, 256))
         # If the image is big, scale down to 512x512 first using a faster
         # but lower quality scaling algorithm (Image.NEAREST)
         if image.size[0] > 512:
             image.thumbnail((512, 512), Image.NEAREST)
         image.thumbnail((256, 256), Image.ANTIALIAS)
         image.save(path2thumbnail(path))
-    elif guess_type(path)[0] in thumbnailers.keys():
+    elif thumbnailer is not None:
         o = path2thumbnail(path)
-        u = path2url(path)
-        s = "256"
-        command = thumbnailers[guess_type(path)[0]]
-        for (pat, sub) in [("%o", o), ("%i", path), ("%u", u), ("%s", s)]:
-            command = re.sub(pat, sub, command)
-        os.system(command)
+        executor.submit(thumbnailer, path, o, 256).result()
         try:
             return Image.open(o)
         except:
@@ -57,7 +57,7 @@ class History(plugins.Plugin):
     def prev(self, _):
         self.pathsLogIndex -= 1
         newPath = self.pathsLog[self.pathsLogIndex]
-        self.manager.raiseSignal("change-dir", newPath=newPath, raisedBy=self)
+        self.manager.postSignal("change-dir", newPath=newPath, raisedBy=self)
         if self.pathsLogIndex == 0:
             self.prevButton.set_state(Gtk.StateType.INSENSITIVE)
         self.nextButton.set_state(Gtk.StateType.NORMAL)
@@ -66,7 +66,7 @@ class History(plugins.Plugin):
         self.pathsLogIndex += 1
         print(self.pathsLog)
         newPath = self.pathsLog[self.pathsLogIndex]
-        self.manager.raiseSignal("change-dir", newPath=newPath, raisedBy=self)
+        self.manager.postSignal("change-dir", newPath=newPath, raisedBy=self)
         if self.pathsLogIndex >= len(self.pathsLog) - 1:
             self.nextButton.set_state(Gtk.StateType.INSENSITIVE)
         self.prevButton.set_state(Gtk.StateType.NORMAL)
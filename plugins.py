@@ -1,10 +1,26 @@
 from os.path import isdir, isfile, join, dirname, abspath
 import warnings
 import pickle
+import time
+from collections import deque
+
+import profiler
 
 #import globals
 SOURCE_DIR = dirname(abspath(__file__))
 
+class SignalOrderError(Exception):
+    """Raised when the respondAfter/respondBefore rules of the plug-ins
+    responding to a signal contain a cycle."""
+
+    def __init__(self, signal, cycle):
+        """Creates the error for signal, cycle being the list of plug-in
+        names forming the cycle."""
+        Exception.__init__(self, "Cyclic response order for signal "
+                           "'{}': {}".format(signal, " -> ".join(cycle)))
+        self.signal = signal
+        self.cycle = cycle
+
 class Plugin:
     """ A class that can communicate with other Plugins through
         plugin manager"""
@@ -18,8 +34,7 @@ class Plugin:
         self.respondBefore = {}
         self.responses = {}
         self.id = -1
-        self.responded = False
-        
+
     def addResponse(self, signal, func):
         """Adds response to signal.
         Args
@@ -27,7 +42,25 @@ class Plugin:
             func: function to respond with."""
         self.responses[signal] = func
         self.respondAfter[signal] = []
-        self.respondBefore[signal] = [] 
+        self.respondBefore[signal] = []
+        self.invalidateDispatchPlan(signal)
+
+    def addRespondAfter(self, signal, pluginName):
+        """Makes the plug-in respond to signal after pluginName."""
+        self.respondAfter[signal].append(pluginName)
+        self.invalidateDispatchPlan(signal)
+
+    def addRespondBefore(self, signal, pluginName):
+        """Makes the plug-in respond to signal before pluginName."""
+        self.respondBefore[signal].append(pluginName)
+        self.invalidateDispatchPlan(signal)
+
+    def invalidateDispatchPlan(self, signal):
+        """Tells the manager that the responses to signal changed.
+        Needed only if respondAfter/respondBefore are modified directly
+        after the plug-in has been added to the manager."""
+        if self.manager is not None:
+            self.manager.invalidateDispatchPlan(signal)
 
     def __str__(self):
         """Return plugin name."""
@@ -35,98 +68,260 @@ class Plugin:
         
 class PluginManager:
     """ A helper class to manage plugins and signals"""
-    def __init__(self):
-        """ Initializes PluginManager"""
-        self.getPluginsList()
+    def __init__(self, pluginsList=None, start=True):
+        """ Initializes PluginManager
+        Args
+            pluginsList: Lines in the format of plugins.list to use
+            instead of the file, for example in benchmarks.
+            start: Whether to raise "started". If False, the caller
+            raises it after adding plug-ins of its own."""
+        self.dispatchPlans = {}
+        # [signal, args, kwargs] of signals posted with postSignal
+        self.queue = deque()
+        self.queueSource = None
+        # profiler.Profiler if profiling is enabled, None otherwise
+        self.profiler = profiler.fromEnvironment()
+        # Whether "started" has been raised, lazily loaded plug-ins
+        # catch up on it when they are loaded later.
+        self.isStarted = False
+        if pluginsList is None:
+            self.getPluginsList()
+        else:
+            self.parsePluginsList(pluginsList)
         self.loadPlugins()
+        if start:
+            self.start()
+
+    def start(self):
+        """Raises "started"."""
+        self.isStarted = True
         self.raiseSignal("started")
         
     def getPluginsList(self):
         """Gets plugins list from plugins.list if present, otherwise
-        calls getDefaultPluginsList"""
+        calls getDefaultPluginsList. Each line of plugins.list names a
+        plug-in module, optionally followed by its manifest fields:
+            signals=a,b   the plug-in is loaded only once one of these
+                          signals is raised, or another plug-in needs it
+            requires=c,d  plug-ins to load before this one
+        Anything after # is a comment."""
         pluginsListFile = join(SOURCE_DIR, "plugins.list")
         if not isfile(pluginsListFile):
             warnings.warn("plugins.list not found, loading default values", 
                     Warning)
-            self.pluginsList = self.getDefaultPluginsList()
+            lines = self.getDefaultPluginsList()
         else:
             with open(pluginsListFile) as f:
-                # comprehension ignores empty lines
-                self.pluginsList = [p for p in f.read().splitlines() if p]
+                lines = f.read().splitlines()
+        self.parsePluginsList(lines)
+
+    def parsePluginsList(self, lines):
+        """Sets pluginsList and manifest from lines of plugins.list."""
+        self.pluginsList = []
+        # name: (signals, requires) of each listed plug-in
+        self.manifest = {}
+        for line in lines:
+            fields = line.split("#")[0].split()
+            if not fields: # empty line
+                continue
+            name = fields[0]
+            signals = []
+            requires = []
+            for field in fields[1:]:
+                (key, _, value) = field.partition("=")
+                values = [v for v in value.split(",") if v]
+                if key == "signals":
+                    signals = values
+                elif key == "requires":
+                    requires = values
+                else:
+                    warnings.warn("Unknown field {} of plug-in {}".format(
+                                  key, name), Warning)
+            self.pluginsList.append(name)
+            self.manifest[name] = (signals, requires)
         
     def getDefaultPluginsList(self):
         """Returns default list of plugins. Called if getPluginsList fails."""
         return ["settings","guiManager","dirTree"]
         
     def loadPlugins(self):
-        """Imports modules containing the plug-ins."""
+        """Imports modules containing the plug-ins. Plug-ins declaring
+        signals in their manifest are loaded when they are needed."""
         self.plugins = []
         self.pluginNames = {}
-        pluginId = 0
+        self.invalidateDispatchPlan()
+        # Names of the plug-ins loaded, or tried to be loaded
+        self.loadedPlugins = set()
+        # signal: names of plug-ins to load once signal is raised
+        self.lazyPlugins = {}
+        for pluginName in self.pluginsList:
+            for signal in self.manifest[pluginName][0]:
+                self.lazyPlugins.setdefault(signal, []).append(pluginName)
         for pluginName in self.pluginsList:
-            pluginPath = join(SOURCE_DIR, pluginName + ".py")
-            if isfile(pluginPath ):
+            if not self.manifest[pluginName][0]:
+                self.loadPlugin(pluginName)
+
+    def loadPlugin(self, pluginName, signal=None):
+        """Imports and creates plug-in pluginName along with the
+        plug-ins it requires, if not already done. signal is the
+        signal the plug-in is loaded for, if any. Plug-ins loaded after
+        start get "started" right away."""
+        if pluginName in self.loadedPlugins:
+            return
+        self.loadedPlugins.add(pluginName)
+        for required in self.manifest.get(pluginName, ([], []))[1]:
+            self.loadPlugin(required)
+        pluginPath = join(SOURCE_DIR, pluginName + ".py")
+        if not isfile(pluginPath):
+            warnings.warn("Failed to load plug-in %s" %pluginName, Warning)
+            return
+        if self.profiler is None:
+            module = __import__(pluginName)
+            newPlugin = module.createPlugin(self)
+        else:
+            with self.profiler.span("import", pluginName):
                 module = __import__(pluginName)
+            with self.profiler.span("create", pluginName):
                 newPlugin = module.createPlugin(self)
-                newPlugin.id = pluginId
-                pluginId += 1
-                self.plugins.append(newPlugin)
-                self.pluginNames[newPlugin.pname] = newPlugin
-                print ("Plug-in loaded: {}".format(pluginName))
-            else:
-                warnings.warn("Failed to load plug-in %s" %pluginName, Warning)
+        # plug-ins listed first respond first, wherever they are loaded
+        if pluginName in self.manifest:
+            newPlugin.id = self.pluginsList.index(pluginName)
+        else:
+            newPlugin.id = len(self.pluginsList) + len(self.plugins)
+        self.addPlugin(newPlugin)
+        print ("Plug-in loaded: {}".format(pluginName))
+        for dependency in newPlugin.dependencies:
+            if dependency in self.manifest:
+                self.loadPlugin(dependency)
+        if (self.isStarted and signal != "started" and
+                "started" in newPlugin.responses):
+            newPlugin.responses["started"]("started")
             
+    def addPlugin(self, plugin):
+        """Registers an already created plug-in and invalidates the
+        dispatch plans it takes part in."""
+        self.plugins.append(plugin)
+        self.pluginNames[plugin.pname] = plugin
+        self.invalidateDispatchPlan()
+
+    def removePlugin(self, plugin):
+        """Unregisters plug-in and invalidates the dispatch plans."""
+        self.plugins.remove(plugin)
+        if self.pluginNames.get(plugin.pname) is plugin:
+            del self.pluginNames[plugin.pname]
+        self.invalidateDispatchPlan()
+
+    def invalidateDispatchPlan(self, signal=None):
+        """Drops the cached dispatch plan of signal, or all plans if
+        signal is None. Plans are rebuilt on the next raiseSignal."""
+        if signal is None:
+            self.dispatchPlans = {}
+        else:
+            self.dispatchPlans.pop(signal, None)
+
     def raiseSignal(self, signal, *args, **kwargs):
         """Raises signal with given args."""
-        raiseTo = self.getPluginsToRaiseSignal(signal)
-        for target in raiseTo:
-            target.responses[signal](signal, *args, **kwargs)
-        
+        try:
+            plan = self.dispatchPlans[signal]
+        except KeyError:
+            plan = self.buildDispatchPlan(signal)
+        if self.profiler is not None:
+            self.raiseProfiled(signal, plan, args, kwargs)
+            return
+        for response in plan:
+            response(signal, *args, **kwargs)
+
+    def postSignal(self, signal, *args, coalesce=True, **kwargs):
+        """Queues signal to be raised from the GLib main loop, after
+        pending input events are handled. If coalesce is True and the
+        signal queued last is the same signal, it is replaced, so only
+        the latest of a quick series of signals is raised. Use
+        raiseSignal for signals whose effects are needed right away."""
+        from gi.repository import GLib
+        if coalesce and self.queue and self.queue[-1][0] == signal:
+            self.queue[-1][1:] = [args, kwargs]
+        else:
+            self.queue.append([signal, args, kwargs])
+        if self.queueSource is None:
+            self.queueSource = GLib.idle_add(self.raiseQueued,
+                                             priority=GLib.PRIORITY_HIGH_IDLE)
+
+    def raiseQueued(self):
+        """Raises the queued signals. Signals posted meanwhile are
+        raised on the next run."""
+        self.queueSource = None
+        queue = self.queue
+        self.queue = deque()
+        for (signal, args, kwargs) in queue:
+            self.raiseSignal(signal, *args, **kwargs)
+        return False
+
+    def raiseProfiled(self, signal, plan, args, kwargs):
+        """Calls the responses of plan, recording the time each takes
+        and the time of the whole signal."""
+        begin = time.perf_counter()
+        for response in plan:
+            start = time.perf_counter()
+            response(signal, *args, **kwargs)
+            self.profiler.record("handler", "{} {}".format(
+                signal, getattr(response, "__qualname__", response)),
+                start, time.perf_counter())
+        self.profiler.record("signal", signal, begin, time.perf_counter())
+
+    def buildDispatchPlan(self, signal):
+        """Creates and caches the list of responses to signal in the
+        order they have to be called. Plug-ins waiting for signal are
+        loaded first."""
+        for pluginName in self.lazyPlugins.pop(signal, []):
+            self.loadPlugin(pluginName, signal)
+        plan = [plugin.responses[signal]
+                for plugin in self.getPluginsToRaiseSignal(signal)]
+        self.dispatchPlans[signal] = plan
+        return plan
+
     def getPluginsToRaiseSignal(self, signal):
         """Returns a list of plug-ins in the order they can respond
-        to signal."""
-        result = [] #TODO check if it is possible
-        # O(n*m) get plugins that respond to signal
-        candidates = [c for c in self.plugins if signal in c.responses.keys()]
-        n = len(self.plugins)
-        # O(n^2) create a nxm matrix for faster comprasion,
-        # compMap[i][j] == True means plugins with id i responds after j
-        compMap = [[False for i in range(n)] for j in range(n)]
-        for c1 in candidates:
-            for earlyPluginName in c1.respondAfter[signal]:
-                earlyPlugin = self.pluginNames[earlyPluginName]
-                compMap[c1.id][earlyPlugin.id] = True
-            for latePluginName in c1.respondBefore[signal]:
-                latePlugin = self.pluginNames[latePluginName]
-                compMap[latePlugin.id][c1.id] = True
-        # O(n) Clear respondAfter and respondBefore to merge both using
-        # compMap
+        to signal. Raises SignalOrderError if the ordering rules of
+        the responding plug-ins contain a cycle."""
+        candidates = [p for p in self.plugins if signal in p.responses]
+        candidates.sort(key=lambda p: p.id)
+        # Ordering rules only matter between plug-ins responding to signal,
+        # rules naming other or missing plug-ins are ignored.
+        responding = {p.pname: p for p in candidates}
+        earlier = {p.id: [] for p in candidates}
+        for plugin in candidates:
+            for name in plugin.respondAfter.get(signal, []):
+                if name in responding:
+                    earlier[plugin.id].append(responding[name])
+            for name in plugin.respondBefore.get(signal, []):
+                if name in responding:
+                    earlier[responding[name].id].append(plugin)
+        # Depth first topological sort, keeping plug-in order where
+        # the rules allow it.
+        result = []
+        state = {}
         for candidate in candidates:
-            candidate.responded = False  
-            candidate.respondAfter[signal] = []
-            candidate.respondBefore[signal] = []
-        # O(n^2) recreate respondAfter
-        for i in range(n):
-            for j in range(n):
-                if compMap[i][j]:
-                    name = self.plugins[j].pname
-                    self.plugins[i].respondAfter[signal].append(name)
-        # o (n^2) create plugins list in order they respond
-        i = 0
-        while i < len(candidates):
-            plugin = candidates[i]
-            if plugin.responded:
-                i += 1
+            if candidate.id in state:
                 continue
-            found = True
-            while found:
-                found = False
-                for upperName in  plugin.respondAfter[signal]:
-                    upper = self.pluginNames[upperName]
-                    if not upper.responded:
-                        plugin = upper
-                        found = True
+            stack = [(candidate, iter(sorted(earlier[candidate.id],
+                                             key=lambda p: p.id)))]
+            state[candidate.id] = "visiting"
+            while stack:
+                plugin, pending = stack[-1]
+                for upper in pending:
+                    upperState = state.get(upper.id)
+                    if upperState == "visiting":
+                        cycle = [p for (p, _) in stack]
+                        cycle = cycle[cycle.index(upper):] + [upper]
+                        raise SignalOrderError(signal,
+                                               [p.pname for p in cycle])
+                    if upperState is None:
+                        state[upper.id] = "visiting"
+                        stack.append((upper, iter(sorted(earlier[upper.id],
+                                                       key=lambda p: p.id))))
                         break
-            plugin.responded = True                        
-            result.append(plugin)
+                else:
+                    stack.pop()
+                    state[plugin.id] = "done"
+                    result.append(plugin)
         return result
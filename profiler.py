@@ -0,0 +1,101 @@
+"""
+profiler
+
+Timing of plug-in loading and signal handling. PluginManager uses a
+Profiler if the FILEBROWSER_PROFILE environment variable is set: a
+report sorted by total time is printed to stderr at exit. If
+FILEBROWSER_TRACE is set to a path, the recorded spans are also written
+there as Chrome trace events, to be opened in chrome://tracing or
+Perfetto.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+from contextlib import contextmanager
+
+class Profiler(object):
+    """Collects timed spans and instant marks. Times are taken with
+    time.perf_counter and kept relative to the creation of the
+    Profiler."""
+
+    def __init__(self, tracePath=None):
+        """Creates a Profiler, writing a trace to tracePath at dump if
+        it is not None."""
+        self.tracePath = tracePath
+        self.start = time.perf_counter()
+        # (category, name): [count, total seconds, max seconds]
+        self.totals = {}
+        # Chrome trace events
+        self.events = []
+
+    def record(self, category, name, begin, end):
+        """Records a span of name that lasted from begin to end, both
+        perf_counter values."""
+        duration = end - begin
+        total = self.totals.get((category, name))
+        if total is None:
+            self.totals[(category, name)] = [1, duration, duration]
+        else:
+            total[0] += 1
+            total[1] += duration
+            if duration > total[2]:
+                total[2] = duration
+        if self.tracePath is not None:
+            self.events.append({"name": name, "cat": category, "ph": "X",
+                                "ts": (begin - self.start) * 1e6,
+                                "dur": duration * 1e6,
+                                "pid": os.getpid(), "tid": 0})
+
+    @contextmanager
+    def span(self, category, name):
+        """Context recording the time spent in it."""
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(category, name, begin, time.perf_counter())
+
+    def mark(self, name):
+        """Records an instant event, like the first window draw."""
+        now = time.perf_counter()
+        self.totals.setdefault(("mark", name), [1, now - self.start,
+                                                now - self.start])
+        if self.tracePath is not None:
+            self.events.append({"name": name, "cat": "mark", "ph": "i",
+                                "s": "g", "ts": (now - self.start) * 1e6,
+                                "pid": os.getpid(), "tid": 0})
+
+    def report(self):
+        """Returns the timing report as a string, slowest first. For
+        marks, the time is the time since the Profiler was created."""
+        lines = ["{:<8} {:<48} {:>7} {:>10} {:>10} {:>10}".format(
+                 "kind", "name", "count", "total ms", "mean ms", "max ms")]
+        rows = sorted(self.totals.items(), key=lambda i: -i[1][1])
+        for ((category, name), (count, total, longest)) in rows:
+            lines.append("{:<8} {:<48} {:>7} {:>10.2f} {:>10.2f} "
+                         "{:>10.2f}".format(category, name[:48], count,
+                                            total * 1e3,
+                                            total / count * 1e3,
+                                            longest * 1e3))
+        return "\n".join(lines)
+
+    def dump(self):
+        """Prints the report to stderr and writes the trace file."""
+        print(self.report(), file=sys.stderr)
+        if self.tracePath is not None:
+            with open(self.tracePath, "w") as f:
+                json.dump({"traceEvents": self.events,
+                           "displayTimeUnit": "ms"}, f)
+
+def fromEnvironment():
+    """Returns a Profiler dumped at exit if FILEBROWSER_PROFILE or
+    FILEBROWSER_TRACE is set, None otherwise."""
+    tracePath = os.environ.get("FILEBROWSER_TRACE") or None
+    if not os.environ.get("FILEBROWSER_PROFILE") and tracePath is None:
+        return None
+    profiler = Profiler(tracePath)
+    atexit.register(profiler.dump)
+    return profiler
@@ -1,9 +1,28 @@
 import plugins
+import os
+import json
 import pickle
+import atexit
+import warnings
+import tempfile
+from contextlib import contextmanager
 from os.path import join, dirname, abspath, isdir
-from gi.repository import Gdk
+from gi.repository import Gdk, GLib
 
 SOURCE_DIR = dirname(abspath(__file__))
+SETTINGS_FILE = join(SOURCE_DIR, "settings.json")
+# Pickled settings of older versions, migrated on first start
+LEGACY_SETTINGS_FILE = join(SOURCE_DIR, "settings")
+SCHEMA_VERSION = 1
+
+# name: Setting subclass used to check the stored value of name
+registry = {}
+
+def registerSetting(name, settingType):
+    """Registers settingType, a Setting subclass that can be created
+    without arguments, as the type of setting name. Stored values are
+    checked against it on first access."""
+    registry[name] = settingType
 
 class Setting(object):
     """Basic class for settings"""
@@ -28,6 +47,10 @@ class Setting(object):
         """Sets value to its default."""
         pass
 
+    def setToDefault(self):
+        """Sets value to its default."""
+        self.setDefault()
+
 
 class DirPathSetting(Setting):
     """Setting class for directory paths"""  
@@ -71,6 +94,83 @@ class BooleanSetting(Setting):
         else:
             raise ValueError("Invalid value {}".format(value))"""
         
+class SettingsDict(dict):
+    """The dict of settings handed out to plug-ins. Values loaded from
+    disk are kept plain until a setting is first accessed, then they
+    are checked by creating the registered Setting type. It also gives
+    plug-ins the transaction context of the Settings plug-in."""
+
+    def __init__(self, plugin, values=None):
+        """Creates a SettingsDict saved by plugin, values being a
+        name: plain value dict loaded from disk."""
+        dict.__init__(self)
+        self.plugin = plugin
+        # name: plain value not turned into a Setting yet
+        self.plain = dict(values or {})
+
+    def __missing__(self, name):
+        """Creates the Setting of name from its plain value."""
+        if name not in self.plain:
+            raise KeyError(name)
+        value = self.plain.pop(name)
+        settingType = registry.get(name)
+        if settingType is None:
+            setting = Setting(value)
+        else:
+            setting = settingType()
+            try:
+                setting.set(value)
+            except (ValueError, TypeError):
+                warnings.warn("Invalid value of setting {}, using the "
+                              "default".format(name), Warning)
+        dict.__setitem__(self, name, setting)
+        return setting
+
+    def __setitem__(self, name, setting):
+        """Sets the Setting of name, dropping its plain value."""
+        self.plain.pop(name, None)
+        dict.__setitem__(self, name, setting)
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self.plain
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.plain)
+
+    def keys(self):
+        """Returns names of all settings, checked or not."""
+        return set(dict.keys(self)) | set(self.plain)
+
+    def items(self):
+        """Returns (name, Setting) pairs of all settings, checking the
+        ones not accessed yet."""
+        return [(name, self[name]) for name in self.keys()]
+
+    def values(self):
+        """Returns the Settings of all settings, checking the ones not
+        accessed yet."""
+        return [self[name] for name in self.keys()]
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def dump(self):
+        """Returns settings as a name: plain value dict."""
+        values = dict(self.plain)
+        for (name, setting) in dict.items(self):
+            if not hasattr(setting, "value"):
+                continue
+            value = setting.value
+            values[name] = list(value) if type(value) is tuple else value
+        return values
+
+    def transaction(self):
+        """Returns the Settings.transaction context."""
+        return self.plugin.transaction()
+
 class Settings(plugins.Plugin):
     """The settings plug-in load the settings from disk, sends 
     to other plug-ins or changes on request."""
@@ -85,15 +185,63 @@ class Settings(plugins.Plugin):
         self.addResponse("revert-to-defaults", self.onRevertDefault)
         self.addResponse("revert-default-settings", self.onRevertDefault)
         self.addResponse("set-new-setting", self.onSetNewSetting)
+        self.settingsPath = SETTINGS_FILE
+        # Changes are written this many milliseconds after the last one
+        self.delay = 500
+        self.dirty = False
+        self.saveSource = None
+        self.transactionDepth = 0
+        atexit.register(self.flush)
         
     def onStart(self, signal, *args, **kwargs):
-        """Loads settings from disk."""
-        settingsPath = join(SOURCE_DIR, "settings")
+        """Loads settings from disk. Pickled settings of older versions
+        are migrated."""
+        values = self.load()
+        if values is None:
+            values = self.loadLegacy()
+            self.settings = SettingsDict(self, values)
+            if values:
+                self.dirty = True
+                self.flush()
+        else:
+            self.settings = SettingsDict(self, values)
+
+    def load(self):
+        """Returns the name: plain value dict stored on disk, None if
+        there is no settings file."""
         try:
-            with open(settingsPath, "rb") as f:
-                self.settings = pickle.load(f)
-        except:
-            self.settings = {} 
+            with open(self.settingsPath, "r") as f:
+                data = json.load(f)
+            if data["version"] > SCHEMA_VERSION:
+                warnings.warn("Settings were saved by a newer version",
+                              Warning)
+            return dict(data["settings"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            # Keep the broken file instead of overwriting it
+            warnings.warn("Failed to load settings: {}".format(e), Warning)
+            try:
+                os.replace(self.settingsPath, self.settingsPath + ".broken")
+            except OSError:
+                pass
+            return {}
+
+    def loadLegacy(self):
+        """Returns the name: plain value dict of pickled settings, an
+        empty dict if there are none. Unpickling imports the modules
+        defining the Setting types, this is done only once."""
+        try:
+            with open(LEGACY_SETTINGS_FILE, "rb") as f:
+                settings = pickle.load(f)
+            return {name: setting.value for (name, setting)
+                    in settings.items() if hasattr(setting, "value")}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            warnings.warn("Failed to migrate settings: {}".format(e),
+                          Warning)
+            return {}
         
     def onRequestSettings(self, signal, *args, **kwargs):
         """Sets kwargs["widget"].settings to self."""
@@ -110,8 +258,8 @@ class Settings(plugins.Plugin):
         
     def onRevertDefault(self, signal, *args, **kwargs):
         """Loads default settings and saves changes to disk."""
-        for setting in self.settings:
-            setting.setDefault()
+        for name in self.settings.keys():
+            self.settings[name].setToDefault()
         self.save()
         
     def onSetNewSetting(self, signal, *args, **kwargs):
@@ -123,11 +271,58 @@ class Settings(plugins.Plugin):
         self.settings[name] = setting
         self.save()
 
+    @contextmanager
+    def transaction(self):
+        """Context in which changes are not saved before it is left,
+        for updating many settings at once."""
+        self.transactionDepth += 1
+        try:
+            yield self.settings
+        finally:
+            self.transactionDepth -= 1
+            if self.transactionDepth == 0 and self.dirty:
+                self.scheduleFlush()
+
     def save(self):
-        """Saves settings to disk"""
-        settingsPath = join(SOURCE_DIR, "settings")    
-        with open(settingsPath, "wb") as f:
-            pickle.dump(self.settings, f)    
+        """Marks settings changed. They are written to disk once no
+        changes were made for a while, or at exit."""
+        self.dirty = True
+        if self.transactionDepth == 0:
+            self.scheduleFlush()
+
+    def scheduleFlush(self):
+        """(Re)starts the timer writing settings to disk."""
+        if self.saveSource is not None:
+            GLib.source_remove(self.saveSource)
+        self.saveSource = GLib.timeout_add(self.delay, self.onSaveTimeout)
+
+    def onSaveTimeout(self):
+        """Writes the settings, called by the save timer."""
+        self.saveSource = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """Writes settings to disk now if they changed. The file is
+        replaced atomically, so a crash can't leave it half written."""
+        if self.saveSource is not None:
+            GLib.source_remove(self.saveSource)
+            self.saveSource = None
+        if not self.dirty:
+            return
+        self.dirty = False
+        data = {"version": SCHEMA_VERSION, "settings": self.settings.dump()}
+        (fd, tmpPath) = tempfile.mkstemp(dir=dirname(self.settingsPath),
+                                         prefix=".settings-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpPath, self.settingsPath)
+        except:
+            os.unlink(tmpPath)
+            raise
 
 def createPlugin(manager):
     return Settings(manager)
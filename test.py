@@ -2,5 +2,7 @@ from gi.repository import Gtk
 
 import plugins as p
 
-p.PluginManager()
-Gtk.main()
+# Guarded, as thumbnailPrewarmer's worker processes import this module
+if __name__ == "__main__":
+    p.PluginManager()
+    Gtk.main()
@@ -0,0 +1,228 @@
+"""
+thumbnailPrewarmer
+
+thumbnailPrewarmer plug-in creates missing or outdated thumbnails of
+directory subtrees in the background, so that browsing into them finds
+the thumbnails already saved.
+
+Signals:
+prewarm-thumbnails: onPrewarm, with path (the directory) and
+optionally depth (levels of subdirectories to walk into).
+quitting: onQuit
+"""
+
+import os
+import sys
+import time
+import signal
+import ctypes
+import multiprocessing
+from threading import Thread, Lock, BoundedSemaphore
+from queue import Queue
+
+import settings
+import plugins
+import thumbnails
+import thumbnailers
+
+# ioprio_set system call numbers, the idle class is served only when
+# no other process needs the disk
+IOPRIO_SET = {"x86_64": 251, "i686": 289, "aarch64": 30, "armv7l": 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+def lowerPriority():
+    """Gives the calling process the lowest CPU priority and, on
+    Linux, the idle I/O priority class."""
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+    syscall = IOPRIO_SET.get(os.uname().machine)
+    if sys.platform.startswith("linux") and syscall is not None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.syscall(syscall, IOPRIO_WHO_PROCESS, 0,
+                         IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+        except (OSError, AttributeError):
+            pass
+
+def stopWorker(signum, frame):
+    """Kills the thumbnailers of a pool process being terminated, which
+    run in their own sessions, then exits."""
+    thumbnailers.executor.shutdown()
+    os._exit(0)
+
+def initWorker():
+    """Lowers the priority of a pool process and makes terminating it
+    stop its thumbnailers. Runs in each pool process."""
+    lowerPriority()
+    signal.signal(signal.SIGTERM, stopWorker)
+
+def isHidden(name):
+    """Returns whether file named name is hidden."""
+    return name[0] == "." or name[-1] == "~"
+
+class PrewarmRateSetting(settings.Setting):
+    """Setting for the number of thumbnails the prewarmer creates per
+    second at most. 0 turns prewarming off."""
+
+    def __init__(self):
+        """Creates PrewarmRateSetting object."""
+        settings.Setting.__init__(self)
+        self.setToDefault()
+
+    def isValidValue(self, value):
+        """Returns whether value is a valid rate."""
+        return (type(value) is int) and (0 <= value <= 10000)
+
+    def setToDefault(self):
+        """Sets the rate to the default value."""
+        self.set(20)
+
+settings.registerSetting("thumbnail-prewarm-rate", PrewarmRateSetting)
+
+class ThumbnailPrewarmer(plugins.Plugin):
+    """Walks the directories asked for in a background thread and
+    creates the thumbnails that are missing or older than their files
+    in a pool of low priority processes. Directories already walked
+    are skipped until they change."""
+
+    def __init__(self, manager):
+        """Creates a ThumbnailPrewarmer object."""
+        plugins.Plugin.__init__(self, manager)
+        self.pname = "thumbnailPrewarmer"
+        self.dependencies.append("settings")
+        self.addResponse("prewarm-thumbnails", self.onPrewarm)
+        self.addResponse("quitting", self.onQuit)
+        self.settings = None
+        # Levels of subdirectories walked if not given with the signal
+        self.depth = 2
+        self.workers = max(1, (os.cpu_count() or 2) // 2)
+        # Thumbnails created by one job, downscaled together
+        self.batchSize = 8
+        self.pool = None
+        # Guards creating and terminating the pool
+        self.lock = Lock()
+        self.stopped = False
+        self.thread = None
+        # (path, depth, size, rate) of the walks to do
+        self.requests = Queue()
+        # path: mtime of the directories walked
+        self.walked = {}
+        self.nextSubmit = 0
+        # Bounds the batches queued in the pool
+        self.slots = BoundedSemaphore(2 * self.workers)
+
+    def onPrewarm(self, signal, *args, **kwargs):
+        """Queues prewarming the thumbnails under kwargs["path"]."""
+        if self.settings is None:
+            self.manager.raiseSignal("request-settings", widget=self)
+            with self.settings.transaction():
+                if "thumbnail-prewarm-rate" not in self.settings.keys():
+                    self.manager.raiseSignal("set-new-setting",
+                                            name="thumbnail-prewarm-rate",
+                                            setting=PrewarmRateSetting())
+        rate = self.settings["thumbnail-prewarm-rate"].value
+        if (self.stopped or rate == 0
+                or "thumbnail-size" not in self.settings.keys()):
+            return
+        size = self.settings["thumbnail-size"].value
+        depth = kwargs.get("depth", self.depth)
+        self.requests.put((kwargs["path"], depth, size, rate))
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def onQuit(self, signal, *args, **kwargs):
+        """Stops the walk, drops the queued batches and terminates the
+        pool processes, so that quitting doesn't wait for them."""
+        with self.lock:
+            self.stopped = True
+            pool = self.pool
+        if pool is not None:
+            pool.terminate()
+
+    def run(self):
+        """Walks the requested directories, runs in the background
+        thread."""
+        while not self.stopped:
+            (path, depth, size, rate) = self.requests.get()
+            batch = []
+            for filePath in self.walk(path, depth):
+                if self.stopped:
+                    return
+                # Checking reads a PNG header, only creating is throttled
+                if thumbnails.isThumbnailFresh(filePath, size):
+                    continue
+                self.throttle(rate)
+                batch.append(filePath)
+                if len(batch) == self.batchSize:
+                    self.submit(batch, size)
+                    batch = []
+            if batch:
+                self.submit(batch, size)
+
+    def walk(self, path, depth):
+        """Yields the files under path, down to depth levels of
+        subdirectories, that may need a thumbnail. Hidden entries and
+        directories unchanged since they were walked are skipped."""
+        stack = [(path, depth)]
+        while stack:
+            (path, depth) = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                if self.walked.get(path) == mtime:
+                    continue
+                self.walked[path] = mtime
+                with os.scandir(path) as entries:
+                    entries = sorted(entries, key=lambda e: e.name)
+            except OSError:
+                continue
+            for entry in entries:
+                if isHidden(entry.name):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if depth > 0:
+                            stack.append((entry.path, depth - 1))
+                    elif (entry.is_file()
+                          and thumbnails.canThumbnail(entry.path)):
+                        yield entry.path
+                except OSError:
+                    continue
+
+    def throttle(self, rate):
+        """Sleeps so that at most rate thumbnails are submitted per
+        second."""
+        now = time.monotonic()
+        if self.nextSubmit > now:
+            time.sleep(self.nextSubmit - now)
+            now = self.nextSubmit
+        self.nextSubmit = now + 1.0 / rate
+
+    def submit(self, paths, size):
+        """Queues the thumbnails of paths in the process pool, waiting
+        if too many batches are queued already."""
+        with self.lock:
+            if self.stopped:
+                return
+            if self.pool is None:
+                context = multiprocessing.get_context("spawn")
+                self.pool = context.Pool(self.workers, initializer=initWorker)
+        self.slots.acquire()
+        try:
+            self.pool.apply_async(thumbnails.prewarmThumbnails, (paths, size),
+                                  callback=self.release,
+                                  error_callback=self.release)
+        except ValueError:
+            # pool terminated when quitting
+            self.slots.release()
+
+    def release(self, result):
+        """Frees the slot of a finished batch, runs in a pool thread."""
+        self.slots.release()
+
+def createPlugin(manager):
+    return ThumbnailPrewarmer(manager)
@@ -0,0 +1,218 @@
+"""
+thumbnailers
+
+Registry of the external thumbnailers installed on the system. The
+thumbnailer entries are parsed once and parsed again only when the
+thumbnailers directory changes. Thumbnailers are run by executor,
+which bounds how many run at once and how long each may take.
+"""
+
+import os
+from os.path import join
+import re
+import shlex
+import signal
+import subprocess
+from fnmatch import fnmatchcase
+from threading import Lock
+from mimetypes import guess_type
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+from gi.repository import GLib
+
+#PORT make setting
+THUMBNAILERS_DIR = "/usr/share/thumbnailers/"
+
+def pathToUri(path):
+    """Returns the file URI of path, as passed for %u and as used by
+    the thumbnail spec to name and check thumbnails. GLib escapes it
+    the way other desktop programs do, so thumbnails are shared."""
+    return GLib.filename_to_uri(path, None)
+
+class Thumbnailer(object):
+    """A thumbnailer entry written in Gnome's thumbnailer entry format.
+    The Exec template is split into arguments once, so that creating
+    the command for a file only fills in the %i, %u, %o and %s
+    fields."""
+
+    FIELD = re.compile("(%[iuos%])")
+
+    def __init__(self, name, command, mimeTypes):
+        """Creates a Thumbnailer object.
+        Args
+            name: Name of the thumbnailer entry file.
+            command: Exec template of the entry.
+            mimeTypes: List of MIME types or MIME type globs."""
+        self.name = name
+        self.command = command
+        self.mimeTypes = mimeTypes
+        # Each argument is a list of literal strings and fields
+        self.template = [self.FIELD.split(arg)
+                         for arg in shlex.split(command)]
+
+    def argv(self, path, outputPath, size):
+        """Returns the command creating the thumbnail of the file at
+        path as a list of arguments."""
+        fields = {"%i": path, "%u": pathToUri(path), "%o": outputPath,
+                  "%s": str(size), "%%": "%"}
+        return ["".join(fields.get(part, part) for part in parts)
+                for parts in self.template]
+
+class ThumbnailerRegistry(object):
+    """Thumbnailers indexed by MIME type. MIME types containing
+    wildcards, like image/*, are tried if no exact match is found."""
+
+    def __init__(self, thumbnailersDir=THUMBNAILERS_DIR):
+        """Creates a ThumbnailerRegistry for thumbnailersDir. Entries
+        are loaded on first use."""
+        self.thumbnailersDir = thumbnailersDir
+        self.lock = Lock()
+        self.loaded = False
+        self.mtime = None
+        self.byMimeType = {}
+        self.globs = []
+
+    def refresh(self):
+        """Parses the thumbnailer entries again if the directory has
+        changed since they were last parsed."""
+        try:
+            mtime = os.stat(self.thumbnailersDir).st_mtime_ns
+        except OSError:
+            mtime = None
+        with self.lock:
+            if self.loaded and mtime == self.mtime:
+                return
+            self.byMimeType = {}
+            self.globs = []
+            self.mtime = mtime
+            self.loaded = True
+            if mtime is None:
+                return
+            for thumbnailer in self.parseDir():
+                for mime in thumbnailer.mimeTypes:
+                    if any(c in mime for c in "*?["):
+                        self.globs.append((mime, thumbnailer))
+                    else:
+                        self.byMimeType[mime] = thumbnailer
+
+    def parseDir(self):
+        """Yields the Thumbnailers in the thumbnailers directory."""
+        for filename in sorted(os.listdir(self.thumbnailersDir)):
+            if not filename.endswith(".thumbnailer"):
+                continue
+            try:
+                with open(join(self.thumbnailersDir, filename), "r") as f:
+                    lines = f.read().splitlines()
+            except (OSError, UnicodeDecodeError):
+                continue
+            command = ""
+            mimeTypes = []
+            for line in lines:
+                if line[:5] == "Exec=":
+                    command = line[5:]
+                if line[:9] == "MimeType=":
+                    mimeTypes = [m for m in line[9:].split(";") if m]
+            if command and mimeTypes:
+                try:
+                    yield Thumbnailer(filename, command, mimeTypes)
+                except ValueError:
+                    # unbalanced quotes in Exec
+                    continue
+
+    def forMimeType(self, mime):
+        """Returns the Thumbnailer for MIME type mime or None."""
+        if mime is None:
+            return None
+        self.refresh()
+        thumbnailer = self.byMimeType.get(mime)
+        if thumbnailer is None:
+            for (pattern, candidate) in self.globs:
+                if fnmatchcase(mime, pattern):
+                    return candidate
+        return thumbnailer
+
+    def forPath(self, path):
+        """Returns the Thumbnailer for the file at path or None."""
+        return self.forMimeType(guess_type(path)[0])
+
+class ThumbnailerExecutor(object):
+    """Runs thumbnailers without a shell, at most maxWorkers at a time.
+    A thumbnailer still running after timeout seconds is killed along
+    with the processes it started. shutdown, called when the
+    application quits, drops the queued thumbnailers and kills the
+    running ones."""
+
+    def __init__(self, maxWorkers=None, timeout=30):
+        """Creates a ThumbnailerExecutor. maxWorkers defaults to the
+        number of processors, at most 4."""
+        if maxWorkers is None:
+            maxWorkers = min(os.cpu_count() or 1, 4)
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=maxWorkers,
+                                       thread_name_prefix="thumbnailer")
+        self.lock = Lock()
+        # Thumbnailer processes running
+        self.processes = set()
+        self.closed = False
+
+    def shutdown(self):
+        """Drops the queued thumbnailers and kills the running ones. The
+        pool threads are joined at exit, running every queued job, so
+        this has to be called before."""
+        with self.lock:
+            self.closed = True
+            processes = list(self.processes)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            self.kill(process)
+
+    def kill(self, process):
+        """Kills process, which leads its own session, and the processes
+        it started."""
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def submit(self, thumbnailer, path, outputPath, size):
+        """Queues thumbnailer to create the thumbnail of the file at path
+        in outputPath. Returns a concurrent.futures.Future whose result
+        is True if the thumbnailer exited successfully in time and False
+        if it failed or timed out. Raises CancelledError, as does the
+        result, if the thumbnailer is interrupted by shutdown."""
+        try:
+            return self.pool.submit(self.run,
+                                    thumbnailer.argv(path, outputPath, size))
+        except RuntimeError:
+            # shut down already
+            raise CancelledError()
+
+    def run(self, argv):
+        """Runs argv and waits for it, runs in a pool thread."""
+        with self.lock:
+            if self.closed:
+                raise CancelledError()
+            try:
+                process = subprocess.Popen(argv, stdin=subprocess.DEVNULL,
+                                           stdout=subprocess.DEVNULL,
+                                           stderr=subprocess.DEVNULL,
+                                           start_new_session=True)
+            except OSError:
+                return False
+            self.processes.add(process)
+        try:
+            returncode = process.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.kill(process)
+            process.wait()
+            return False
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+        if returncode != 0 and self.closed:
+            # killed by shutdown
+            raise CancelledError()
+        return returncode == 0
+
+registry = ThumbnailerRegistry()
+executor = ThumbnailerExecutor()
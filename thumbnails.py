@@ -0,0 +1,760 @@
+"""
+thumbnails
+
+Loads and creates thumbnails (uses Gnome thumbnails). Nothing here
+touches Gtk, so the functions can be called from worker threads.
+ThumbnailService runs them in a pool of threads and hands the results
+back to the GTK main loop. Thumbnails created are kept in memory by
+pixbufCache. JPEG files are thumbnailed from their embedded EXIF
+thumbnail when it is large enough and not letterboxed, otherwise
+decoded at reduced scale with PIL if it is installed. With NumPy
+installed, createThumbnails decodes other images at full size and
+downscales them in batches.
+"""
+
+import os
+from os.path import dirname, join, expanduser
+import hashlib
+import heapq
+import itertools
+import mmap
+import struct
+from mimetypes import guess_type
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
+
+from gi.repository import GLib, GdkPixbuf
+from gi.repository.GdkPixbuf import Pixbuf
+
+import thumbnailers
+from thumbnailers import pathToUri
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Directory of thumbnails this program failed to create, under
+# thumbnails/fail as the freedesktop thumbnail spec asks
+FAIL_DIR = "filebrowser-1.0"
+
+# Images with more pixels are decoded scaled by GdkPixbuf instead of at
+# full size for downscaleBatch, and full size images are downscaled as
+# soon as they add up to BATCH_PIXELS, bounding the memory of a batch.
+BATCH_MAX_PIXELS = 4 * 1024 * 1024
+BATCH_PIXELS = 16 * 1024 * 1024
+
+def thumbnailsDir():
+    """Returns the freedesktop thumbnails directory."""
+    cacheHome = os.environ.get("XDG_CACHE_HOME") or expanduser("~/.cache")
+    return join(cacheHome, "thumbnails")
+
+def uriHash(path):
+    """Returns the md5 of the URI of path, naming its thumbnails."""
+    return hashlib.md5(pathToUri(path).encode()).hexdigest()
+
+def pathToThumbnailPath(path, size):
+    """Returns path to thumbnail of file at path (uses Gnome thumbnails)"""
+    #PORT other platforms than gnome
+    if size <= 128: sizeDir = "normal"
+    else: sizeDir = "large"
+    return join(thumbnailsDir(), sizeDir, uriHash(path) + ".png")
+
+def pathToFailPath(path):
+    """Returns path to the file recording that no thumbnail could be
+    created for file at path."""
+    return join(thumbnailsDir(), "fail", FAIL_DIR, uriHash(path) + ".png")
+
+# MIME types GdkPixbuf has loaders for, looked up on first use
+pixbufMimeTypes = None
+
+def canThumbnail(path):
+    """Returns whether a thumbnail can be created for the file at path,
+    judging by its name: GdkPixbuf has a loader for its MIME type or a
+    thumbnailer is installed for it. Other files are not tried, so no
+    failure is recorded for them."""
+    global pixbufMimeTypes
+    mime = guess_type(path)[0]
+    if mime is None:
+        return False
+    if pixbufMimeTypes is None:
+        pixbufMimeTypes = {mimeType for imageFormat in Pixbuf.get_formats()
+                           for mimeType in imageFormat.get_mime_types()}
+    return (mime in pixbufMimeTypes
+            or thumbnailers.registry.forMimeType(mime) is not None)
+
+def thumbMTime(path):
+    """Returns the modification time of path as stored in Thumb::MTime,
+    None if path can't be stat'ed."""
+    try:
+        return str(int(os.stat(path).st_mtime))
+    except OSError:
+        return None
+
+def readPngText(path):
+    """Returns the keywords and texts of the tEXt and uncompressed iTXt
+    chunks of the PNG file at path as a dict. Only the chunks before the
+    image data are read. Returns None if path can't be read or is not a
+    PNG file."""
+    texts = {}
+    try:
+        with open(path, "rb") as f:
+            if f.read(8) != b"\x89PNG\r\n\x1a\n":
+                return None
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return texts
+                (length, kind) = struct.unpack(">I4s", header)
+                if kind in (b"IDAT", b"IEND"):
+                    return texts
+                data = f.read(length)
+                # skip the CRC
+                f.seek(4, os.SEEK_CUR)
+                if kind == b"tEXt":
+                    (keyword, _, text) = data.partition(b"\0")
+                    texts[keyword.decode("latin-1")] = text.decode("latin-1")
+                elif kind == b"iTXt":
+                    (keyword, _, rest) = data.partition(b"\0")
+                    if rest[:1] == b"\0":
+                        # uncompressed, skip language and translated keyword
+                        text = rest[2:].split(b"\0", 2)[-1]
+                        texts[keyword.decode("latin-1")] = text.decode(
+                            "utf-8", "replace")
+    except (OSError, struct.error):
+        return None
+
+def isValidThumbnail(thumbnailPath, uri, mtime):
+    """Returns whether a thumbnail whose Thumb::URI and Thumb::MTime
+    match uri and mtime is saved at thumbnailPath. Only the text chunks
+    are read, the image is not decoded."""
+    texts = readPngText(thumbnailPath)
+    if texts is None or texts.get("Thumb::MTime") != mtime:
+        return False
+    storedUri = texts.get("Thumb::URI")
+    return storedUri is None or storedUri == uri
+
+def loadValidThumbnail(thumbnailPath, uri, mtime):
+    """Returns the pixbuf saved at thumbnailPath if its Thumb::URI and
+    Thumb::MTime match uri and mtime, None otherwise."""
+    if not isValidThumbnail(thumbnailPath, uri, mtime):
+        return None
+    try:
+        return Pixbuf.new_from_file(thumbnailPath)
+    except GLib.Error:
+        return None
+
+def saveThumbnail(pixbuf, thumbnailPath, uri, mtime):
+    """Saves pixbuf at thumbnailPath with the Thumb::URI and
+    Thumb::MTime keys. The file is written under a temporary name and
+    renamed, so readers never see it half written."""
+    try:
+        os.makedirs(dirname(thumbnailPath), mode=0o700, exist_ok=True)
+        tmpPath = "{}.{}.tmp".format(thumbnailPath, os.getpid())
+        pixbuf.savev(tmpPath, "png",
+                     ["tEXt::Thumb::URI", "tEXt::Thumb::MTime"], [uri, mtime])
+        os.chmod(tmpPath, 0o600)
+        os.replace(tmpPath, thumbnailPath)
+    except (OSError, GLib.Error):
+        pass
+
+def recordFailure(path, uri, mtime):
+    """Records that no thumbnail could be created for the file at path
+    as it is now, so that it is not tried again until it changes."""
+    pixbuf = Pixbuf.new(GdkPixbuf.Colorspace.RGB, True, 8, 1, 1)
+    pixbuf.fill(0)
+    saveThumbnail(pixbuf, pathToFailPath(path), uri, mtime)
+
+def hasFailed(path, uri, mtime):
+    """Returns whether creating a thumbnail of the file at path, as it
+    is now, failed before."""
+    return isValidThumbnail(pathToFailPath(path), uri, mtime)
+
+def isThumbnailFresh(path, size):
+    """Returns whether there is nothing to do for the thumbnail of the
+    file at path: a valid thumbnail is saved, or creating one failed
+    for the file as it is now."""
+    mtime = thumbMTime(path)
+    if mtime is None:
+        return True
+    uri = pathToUri(path)
+    return (isValidThumbnail(pathToThumbnailPath(path, size), uri, mtime)
+            or hasFailed(path, uri, mtime))
+
+def prewarmThumbnails(paths, size):
+    """Creates the saved thumbnails of files at paths, found missing or
+    outdated by isThumbnailFresh. Returns the number of thumbnails
+    saved. Used in the processes of thumbnailPrewarmer."""
+    return sum(pixbuf is not None for pixbuf in createThumbnails(paths, size))
+
+def scaleToSize(pixbuf, size):
+    """Scales pixbuf so that its longer side is size, keeping the
+    aspect ratio."""
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    if height > width:
+        width = max(1, size * width // height)
+        height = size
+    else:
+        height = max(1, size * height // width)
+        width = size
+    return pixbuf.scale_simple(width, height, GdkPixbuf.InterpType.BILINEAR)
+
+def fitToSize(pixbuf, size):
+    """Scales pixbuf down so that it fits in size x size."""
+    if max(pixbuf.get_width(), pixbuf.get_height()) > size:
+        return scaleToSize(pixbuf, size)
+    return pixbuf
+
+def pixbufToArray(pixbuf):
+    """Returns the pixels of pixbuf as a height x width x channels
+    uint8 array."""
+    channels = pixbuf.get_n_channels()
+    data = numpy.frombuffer(pixbuf.read_pixel_bytes().get_data(),
+                            numpy.uint8)
+    # the last row isn't padded to the rowstride
+    return numpy.lib.stride_tricks.as_strided(
+        data, shape=(pixbuf.get_height(), pixbuf.get_width(), channels),
+        strides=(pixbuf.get_rowstride(), channels, 1), writeable=False)
+
+def arrayToPixbuf(array):
+    """Returns a Pixbuf of the height x width x channels uint8 array,
+    with 3 or 4 channels. The pixels are copied twice, by tobytes and
+    by GLib.Bytes.new, as PyGObject can't hand NumPy memory to GLib.
+    Rows are not padded, so GdkPixbuf uses the GLib.Bytes as they
+    are."""
+    (height, width, channels) = array.shape
+    data = GLib.Bytes.new(numpy.ascontiguousarray(array).tobytes())
+    return Pixbuf.new_from_bytes(data, GdkPixbuf.Colorspace.RGB,
+                                 channels == 4, 8, width, height,
+                                 width * channels)
+
+def downscaleBatch(arrays, size):
+    """Downscales height x width x channels uint8 arrays by the largest
+    integer factor keeping their longer side at least size, averaging
+    each factor x factor block of pixels. Arrays of the same shape are
+    stacked and reduced with a single reshape and sum, so a directory of
+    equally sized images costs a few NumPy operations. Colors of arrays
+    with an alpha channel are weighted by alpha, so transparent pixels
+    don't darken the edges. Returns the downscaled arrays in the order
+    of arrays, rows and columns left over by the factor are dropped."""
+    groups = {}
+    for (index, array) in enumerate(arrays):
+        factor = max(1, min(max(array.shape[:2]) // size,
+                            min(array.shape[:2])))
+        groups.setdefault((array.shape, factor), []).append(index)
+    results = [None] * len(arrays)
+    for ((shape, factor), indexes) in groups.items():
+        if factor == 1:
+            for index in indexes:
+                results[index] = arrays[index]
+            continue
+        (height, width, channels) = shape
+        height -= height % factor
+        width -= width % factor
+        stack = numpy.stack([arrays[index][:height, :width]
+                             for index in indexes])
+        blocks = stack.reshape(len(indexes), height // factor, factor,
+                               width // factor, factor, channels)
+        area = factor * factor
+        if channels == 4:
+            # Arrays have at most BATCH_MAX_PIXELS pixels and size is at
+            # least 128, so factor is at most 181 and a block sums to at
+            # most 255 * 255 * 181 * 181, which fits in uint32.
+            alpha = blocks[..., 3:].astype(numpy.uint32)
+            alphaSums = alpha.sum(axis=(2, 4), dtype=numpy.uint32)
+            colorSums = (blocks[..., :3] * alpha).sum(axis=(2, 4),
+                                                      dtype=numpy.uint32)
+            weights = numpy.maximum(alphaSums, 1)
+            small = numpy.concatenate(
+                ((colorSums + weights // 2) // weights,
+                 (alphaSums + area // 2) // area), axis=-1)
+        else:
+            sums = blocks.sum(axis=(2, 4), dtype=numpy.uint32)
+            small = (sums + area // 2) // area
+        small = small.astype(numpy.uint8)
+        for (i, index) in enumerate(indexes):
+            results[index] = small[i]
+    return results
+
+def decodeFull(path):
+    """Returns the image at path decoded at full size as an array for
+    downscaleBatch. Returns None for JPEG files, which loadJpeg decodes
+    at reduced scale, for images larger than BATCH_MAX_PIXELS and for
+    files GdkPixbuf can't read."""
+    (imageFormat, width, height) = Pixbuf.get_file_info(path)
+    if (imageFormat is None or imageFormat.get_name() == "jpeg"
+            or width * height > BATCH_MAX_PIXELS):
+        return None
+    try:
+        pixbuf = Pixbuf.new_from_file(path)
+    except GLib.Error:
+        return None
+    return pixbufToArray(pixbuf)
+
+# Start of frame markers, holding the size of the image
+SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+def jpegSegments(data):
+    """Yields (marker, start, end) of the segments of the JPEG image
+    data before the image data, start and end delimiting the payload of
+    the segment."""
+    if data[:2] != b"\xff\xd8":
+        return
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xff:
+            return
+        marker = data[pos+1]
+        if marker in (0xd9, 0xda):
+            # end of image or start of the image data
+            return
+        (length,) = struct.unpack_from(">H", data, pos + 2)
+        yield (marker, pos + 4, pos + 2 + length)
+        pos += 2 + length
+
+def exifThumbnail(data):
+    """Returns the JPEG thumbnail embedded in the EXIF data of the JPEG
+    image data, a bytes-like object, or None if there is none."""
+    try:
+        for (marker, start, end) in jpegSegments(data):
+            if marker == 0xe1 and data[start:start+6] == b"Exif\0\0":
+                return tiffThumbnail(data, start + 6, end)
+    except (struct.error, IndexError):
+        pass
+    return None
+
+def jpegSize(data):
+    """Returns (width, height) of the JPEG image data as given by its
+    start of frame segment, None if it isn't found."""
+    try:
+        for (marker, start, end) in jpegSegments(data):
+            if marker in SOF_MARKERS:
+                (height, width) = struct.unpack_from(">HH", data, start + 1)
+                return (width, height)
+    except (struct.error, IndexError):
+        pass
+    return None
+
+def hasAspectOf(pixbuf, size):
+    """Returns whether pixbuf has the aspect ratio of an image of size
+    (width, height), up to rounding to whole pixels. Embedded thumbnails
+    padded with black bars to a fixed size don't."""
+    if not size or not all(size):
+        return False
+    (width, height) = size
+    return (abs(pixbuf.get_width() * height - pixbuf.get_height() * width)
+            <= max(width, height))
+
+def tiffThumbnail(data, tiff, end):
+    """Returns the thumbnail referenced by IFD1 of the TIFF structure
+    of an EXIF segment starting at tiff and ending at end in data."""
+    byteOrder = data[tiff:tiff+2]
+    if byteOrder == b"II":
+        order = "<"
+    elif byteOrder == b"MM":
+        order = ">"
+    else:
+        return None
+    def read(fmt, offset):
+        return struct.unpack_from(order + fmt, data, tiff + offset)[0]
+    ifd0 = read("I", 4)
+    ifd1 = read("I", ifd0 + 2 + 12 * read("H", ifd0))
+    if ifd1 == 0:
+        return None
+    offset = length = None
+    for i in range(read("H", ifd1)):
+        entry = ifd1 + 2 + 12 * i
+        tag = read("H", entry)
+        if tag == 0x0201: # JPEGInterchangeFormat
+            offset = read("I", entry + 8)
+        elif tag == 0x0202: # JPEGInterchangeFormatLength
+            length = read("I", entry + 8)
+    if not offset or not length or tiff + offset + length > end:
+        return None
+    return data[tiff+offset:tiff+offset+length]
+
+def decodeJpeg(data):
+    """Returns the JPEG image data as a Pixbuf, None if it is broken."""
+    loader = GdkPixbuf.PixbufLoader.new_with_type("jpeg")
+    try:
+        loader.write(data)
+        loader.close()
+    except GLib.Error:
+        return None
+    return loader.get_pixbuf()
+
+def draftDecode(data, size):
+    """Decodes the JPEG image in data, a file-like object, with PIL at
+    the smallest DCT scale still at least size, and fits it in
+    size x size. Returns a Pixbuf or None."""
+    try:
+        image = Image.open(data)
+        image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+        image.thumbnail((size, size), Image.BILINEAR)
+    except (OSError, ValueError, SyntaxError):
+        return None
+    (width, height) = image.size
+    return Pixbuf.new_from_bytes(GLib.Bytes.new(image.tobytes()),
+                                 GdkPixbuf.Colorspace.RGB, False, 8,
+                                 width, height, width * 3)
+
+def loadJpeg(path, size):
+    """Returns a Pixbuf at least size large for the JPEG file at path,
+    without decoding the full image where possible. The file is read
+    through mmap. Returns None if path is not a JPEG file or this
+    fails, the caller then decodes it the usual way."""
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:3] != b"\xff\xd8\xff":
+                    return None
+                thumbnail = exifThumbnail(data)
+                if thumbnail is not None:
+                    pixbuf = decodeJpeg(thumbnail)
+                    if (pixbuf is not None and max(pixbuf.get_width(),
+                            pixbuf.get_height()) >= size
+                            and hasAspectOf(pixbuf, jpegSize(data))):
+                        return fitToSize(pixbuf, size)
+                if Image is not None:
+                    return draftDecode(data, size)
+    except (OSError, ValueError):
+        # empty files can't be mapped
+        pass
+    return None
+
+def thumbnailSize(size):
+    """Returns the size of the saved thumbnails used for size."""
+    if size>128:
+        return 256
+    return 128
+
+def decodeThumbnail(path, tsize, thumbnailPath):
+    """Returns a Pixbuf fitting in tsize x tsize for file at path, or
+    None. Files GdkPixbuf can't read are passed to their thumbnailer,
+    which writes next to thumbnailPath. Raises CancelledError if the
+    thumbnailer is interrupted by quitting, which isn't a failure."""
+    pixbuf = loadJpeg(path, tsize)
+    if pixbuf is None:
+        try:
+            pixbuf = Pixbuf.new_from_file_at_size(path, tsize, tsize)
+        except GLib.Error:
+            pass
+    thumbnailer = None
+    if pixbuf is None:
+        thumbnailer = thumbnailers.registry.forPath(path)
+    if thumbnailer is not None:
+        os.makedirs(dirname(thumbnailPath), mode=0o700, exist_ok=True)
+        outputPath = "{}.{}.out".format(thumbnailPath, os.getpid())
+        try:
+            thumbnailers.executor.submit(thumbnailer, path, outputPath,
+                                         tsize).result()
+            pixbuf = Pixbuf.new_from_file_at_size(outputPath, tsize, tsize)
+        except GLib.Error:
+            pass
+        finally:
+            try:
+                os.remove(outputPath)
+            except OSError:
+                pass
+    return pixbuf
+
+def storeThumbnail(pixbuf, path, thumbnailPath, uri, mtime, size):
+    """Saves pixbuf as the thumbnail of file at path and returns it
+    scaled to size. If pixbuf is None, the failure is recorded and None
+    is returned."""
+    if pixbuf is None:
+        recordFailure(path, uri, mtime)
+        return None
+    saveThumbnail(pixbuf, thumbnailPath, uri, mtime)
+    return scaleToSize(pixbuf, size)
+
+def createThumbnail(path, size):
+    """Returns a thumbnail for file at path as a Pixbuf. The thumbnail is
+    loaded from the thumbnail cache if it is valid for the file, or
+    created and saved there. Returns None if this fails; failures are
+    recorded and not tried again until the file changes. Files of types
+    nothing can thumbnail are not tried. Raises CancelledError if the
+    thumbnailer is interrupted by quitting."""
+    if not canThumbnail(path):
+        return None
+    mtime = thumbMTime(path)
+    if mtime is None:
+        return None
+    uri = pathToUri(path)
+    thumbnailPath = pathToThumbnailPath(path, size)
+    pixbuf = loadValidThumbnail(thumbnailPath, uri, mtime)
+    if pixbuf is not None:
+        return fitToSize(pixbuf, size)
+    if hasFailed(path, uri, mtime):
+        return None
+    pixbuf = decodeThumbnail(path, thumbnailSize(size), thumbnailPath)
+    return storeThumbnail(pixbuf, path, thumbnailPath, uri, mtime, size)
+
+def createThumbnails(paths, size):
+    """Like createThumbnail for many files, returns a list of Pixbufs or
+    Nones in the order of paths. With NumPy installed, images decodeFull
+    reads are downscaled together by downscaleBatch instead of being
+    scaled one by one while decoding."""
+    if numpy is None:
+        return [createThumbnail(path, size) for path in paths]
+    tsize = thumbnailSize(size)
+    results = [None] * len(paths)
+    # (index, thumbnailPath, uri, mtime, array) of the full size images
+    pending = []
+    def flush():
+        arrays = downscaleBatch([p[4] for p in pending], tsize)
+        for ((index, thumbnailPath, uri, mtime, _), array) in zip(pending,
+                                                                  arrays):
+            pixbuf = fitToSize(arrayToPixbuf(array), tsize)
+            results[index] = storeThumbnail(pixbuf, paths[index],
+                                            thumbnailPath, uri, mtime, size)
+        del pending[:]
+    pixels = 0
+    for (index, path) in enumerate(paths):
+        if not canThumbnail(path):
+            continue
+        mtime = thumbMTime(path)
+        if mtime is None:
+            continue
+        uri = pathToUri(path)
+        thumbnailPath = pathToThumbnailPath(path, size)
+        pixbuf = loadValidThumbnail(thumbnailPath, uri, mtime)
+        if pixbuf is not None:
+            results[index] = fitToSize(pixbuf, size)
+            continue
+        if hasFailed(path, uri, mtime):
+            continue
+        array = decodeFull(path)
+        if array is None:
+            pixbuf = decodeThumbnail(path, tsize, thumbnailPath)
+            results[index] = storeThumbnail(pixbuf, path, thumbnailPath, uri,
+                                            mtime, size)
+            continue
+        pending.append((index, thumbnailPath, uri, mtime, array))
+        pixels += array.shape[0] * array.shape[1]
+        if pixels >= BATCH_PIXELS:
+            flush()
+            pixels = 0
+    flush()
+    return results
+
+
+class PixbufCache(object):
+    """Process wide LRU cache of thumbnail pixbufs keyed by
+    (path, mtime, size). The least recently used pixbufs are evicted
+    once their total size exceeds the budget. Safe to use from
+    several threads."""
+
+    def __init__(self, budgetMB=64):
+        """Creates a PixbufCache holding at most budgetMB megabytes."""
+        self.lock = Lock()
+        self.pixbufs = OrderedDict()
+        self.bytes = 0
+        self.budget = budgetMB * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def setBudget(self, budgetMB):
+        """Changes the memory budget, evicting pixbufs if needed."""
+        with self.lock:
+            self.budget = budgetMB * 1024 * 1024
+            self.evict()
+
+    def get(self, path, mtime, size):
+        """Returns the cached pixbuf or None."""
+        with self.lock:
+            pixbuf = self.pixbufs.get((path, mtime, size))
+            if pixbuf is None:
+                self.misses += 1
+                return None
+            self.pixbufs.move_to_end((path, mtime, size))
+            self.hits += 1
+            return pixbuf
+
+    def put(self, path, mtime, size, pixbuf):
+        """Adds pixbuf to the cache."""
+        key = (path, mtime, size)
+        with self.lock:
+            old = self.pixbufs.pop(key, None)
+            if old is not None:
+                self.bytes -= old.get_byte_length()
+            self.pixbufs[key] = pixbuf
+            self.bytes += pixbuf.get_byte_length()
+            self.evict()
+
+    def evict(self):
+        """Drops least recently used pixbufs until the cache fits its
+        budget. The caller must hold the lock."""
+        while self.bytes > self.budget and self.pixbufs:
+            (_, pixbuf) = self.pixbufs.popitem(last=False)
+            self.bytes -= pixbuf.get_byte_length()
+            self.evictions += 1
+
+    def clear(self):
+        """Removes all pixbufs, the counters are kept."""
+        with self.lock:
+            self.pixbufs.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Returns a dict with the counters and the memory in use."""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "entries": len(self.pixbufs),
+                    "bytes": self.bytes, "budget": self.budget}
+
+pixbufCache = PixbufCache()
+
+def getMTime(path):
+    """Returns the modification time of path in nanoseconds or None."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def getCachedThumbnail(path, size, mtime=None):
+    """Like createThumbnail, but looks up pixbufCache first and adds
+    the result to it. mtime is looked up if not given."""
+    if mtime is None:
+        mtime = getMTime(path)
+    pixbuf = pixbufCache.get(path, mtime, size)
+    if pixbuf is None:
+        pixbuf = createThumbnail(path, size)
+        if pixbuf is not None:
+            pixbufCache.put(path, mtime, size, pixbuf)
+    return pixbuf
+
+
+class ThumbnailJob(object):
+    """A request for the thumbnail of path with the given size."""
+
+    def __init__(self, path, size, priority, mtime=None):
+        """Creates a ThumbnailJob object."""
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.priority = priority
+        self.callbacks = []
+        self.cancelled = False
+        self.started = False
+
+    def finish(self, pixbuf):
+        """Passes pixbuf to the callbacks, runs in the main loop."""
+        if not self.cancelled:
+            for callback in self.callbacks:
+                callback(self.path, pixbuf)
+        return False
+
+
+class ThumbnailService(object):
+    """Creates thumbnails in a bounded pool of worker threads. Jobs with
+    lower priority values are served first, callbacks are called from
+    the GTK main loop with (path, pixbuf), pixbuf being None if no
+    thumbnail could be created."""
+
+    def __init__(self, workers=4):
+        """Creates a ThumbnailService with the given number of workers."""
+        self.condition = Condition()
+        self.queue = []
+        self.jobs = {}
+        self.counter = itertools.count()
+        self.workers = 0
+        self.running = 0
+        self.setWorkers(workers)
+
+    def setWorkers(self, workers):
+        """Changes the number of worker threads. Surplus workers exit
+        after finishing their current job."""
+        with self.condition:
+            self.workers = max(1, workers)
+            while self.running < self.workers:
+                self.running += 1
+                Thread(target=self.work, daemon=True).start()
+            self.condition.notify_all()
+
+    def request(self, path, size, callback, priority=0, mtime=None):
+        """Queues a thumbnail request and returns its ThumbnailJob.
+        Requests for a thumbnail that is already queued are merged.
+        If mtime is known and the thumbnail is in pixbufCache, callback
+        is called right away and None is returned."""
+        if mtime is not None:
+            pixbuf = pixbufCache.get(path, mtime, size)
+            if pixbuf is not None:
+                callback(path, pixbuf)
+                return None
+        with self.condition:
+            job = self.jobs.get((path, size))
+            if job is None or job.cancelled:
+                job = ThumbnailJob(path, size, priority, mtime)
+                self.jobs[(path, size)] = job
+                self.push(job)
+            elif priority < job.priority and not job.started:
+                job.priority = priority
+                self.push(job)
+            job.callbacks.append(callback)
+            return job
+
+    def push(self, job):
+        """Adds job to the queue. An older entry of the same job is
+        skipped when popped, as its priority no longer matches."""
+        heapq.heappush(self.queue, (job.priority, next(self.counter), job))
+        self.condition.notify()
+
+    def cancel(self, job, callback):
+        """Removes callback from job. The job is dropped if no callbacks
+        are left and it hasn't started yet."""
+        with self.condition:
+            if callback in job.callbacks:
+                job.callbacks.remove(callback)
+            if not job.callbacks and not job.started:
+                job.cancelled = True
+                if self.jobs.get((job.path, job.size)) is job:
+                    del self.jobs[(job.path, job.size)]
+
+    def cancelAll(self):
+        """Drops all queued jobs. Jobs running are finished but their
+        callbacks are not called."""
+        with self.condition:
+            for job in self.jobs.values():
+                job.cancelled = True
+            self.jobs = {}
+            self.queue = []
+
+    def nextJob(self):
+        """Blocks until a job is available and returns it, or returns
+        None if the worker should exit."""
+        with self.condition:
+            while True:
+                if self.running > self.workers:
+                    self.running -= 1
+                    return None
+                while self.queue:
+                    (priority, _, job) = heapq.heappop(self.queue)
+                    if (job.cancelled or job.started
+                            or priority != job.priority):
+                        continue
+                    job.started = True
+                    return job
+                self.condition.wait()
+
+    def work(self):
+        """Main loop of a worker thread."""
+        while True:
+            job = self.nextJob()
+            if job is None:
+                return
+            try:
+                pixbuf = getCachedThumbnail(job.path, job.size, job.mtime)
+            except Exception:
+                pixbuf = None
+            with self.condition:
+                if self.jobs.get((job.path, job.size)) is job:
+                    del self.jobs[(job.path, job.size)]
+            GLib.idle_add(job.finish, pixbuf)